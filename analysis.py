@@ -1,110 +1,180 @@
-import os
 import json
+import functools
 
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-import statsmodels.api as sm
-
-import plotly.express as px
-import plotly.graph_objects as go
-import keplergl
-
-import plotly.io as pio
-pio.templates.default = "plotly_dark"
 
 from create_shapes import generate_lines
-from download_from_mongodb import get_headers_df
+from lookups import header_names
+from speed_cube import cube_from_partials, save_speed_cube, mean_speed, peak_delta
+import speed_partials
+import runtime_sketches
+import timeline_store
+import render_pool
+from smoothing import rolling_percentile, lowess
 
 color_max_speed_value = 50 # Maximum speed value for color mapping in the maps. This is used to cap the speed values for visualization purposes.
-
-#Retrieve the entire timeline (as points) from .csv files found in historical speed data/data/. Sample data can be found in the historical speed data/sample/ folder.
-def retrieve_timeline(file_limit = 1):
-    files = pd.DataFrame({'filename': os.listdir("historical speed data/data")})
-    files['start_date'] = files.filename.str.extract(r'(\d{4}-\d{2}-\d{2})')[0]
-    files = files.sort_values(by='start_date', ascending=False)
-   
-    timeline = pd.DataFrame()
-    
-    for i, row in files.iterrows():
-        if i < file_limit:
-            file = pd.read_csv("historical speed data/data/" + row['filename'], dtype={"Time": np.int64, "Route": str, "Header": np.int64, "Trip ID": np.int64, "Speed": np.float64, "x": np.float64, "y": np.float64, "Occupancy Status": np.int64})
-            timeline = pd.concat([timeline, file], ignore_index=True)
-
-    #turn into geopandas dataframe based on x and y. Set to NAD UTM 83 10N
-    timeline = gpd.GeoDataFrame(timeline, geometry=gpd.points_from_xy(timeline.x, timeline.y))
-    timeline = timeline.set_crs("EPSG:4326").to_crs("EPSG:26910")
-
-    #turn 'Time' into Datetime column
-    timeline['Datetime'] = pd.to_datetime(timeline['Time'], unit='s', utc=True)
-    #convert to PST
-    timeline['Datetime'] = timeline['Datetime'].dt.tz_convert('America/Los_Angeles')
+lowess_delta_fraction = 0.01 # LOWESS speed/accuracy trade-off for the runtime by time plots. Points within this fraction of the time range are interpolated instead of refitted. 0 gives the exact statsmodels fit.
+
+#plotly and keplergl take a few seconds to import, so they're only imported by the functions that draw something.
+#That keeps importing this module (in notebooks and in every render worker) fast
+def load_plotly():
+    import plotly.express as px
+    import plotly.graph_objects as go
+    import plotly.io as pio
+    pio.templates.default = "plotly_dark"
+    return px, go
+
+#Retrieve the timeline (as points) from the parquet store built from the .csv files in historical speed data/data/. Sample data can be found in the historical speed data/sample/ folder.
+#With no date range, the file_limit most recent weekly files are loaded. Date range, routes and columns are pushed down to the store so only what's needed is read.
+#compact=True loads a narrower schema (32-bit numbers, categorical Route and Header, no unused columns) so more weeks fit in memory.
+#geometry=False skips building a point per ping. The map functions build points from the stored UTM coordinates for just the pings they use.
+def retrieve_timeline(file_limit = 1, start_date = None, end_date = None, routes = None, columns = None, compact = False, geometry = True):
+    #pick up any newly downloaded csv files
+    timeline_store.convert_csv_to_parquet()
+
+    if start_date is None and end_date is None:
+        start_date = timeline_store.recent_start_date(file_limit)
+
+    timeline = timeline_store.read_timeline(start_date, end_date, routes, columns, compact)
+
+    #turn into geopandas dataframe. Points are NAD UTM 83 10N, projected once when the data was stored
+    if geometry and 'utm_x' in timeline.columns and 'utm_y' in timeline.columns:
+        timeline = gpd.GeoDataFrame(timeline, geometry=gpd.points_from_xy(timeline.utm_x, timeline.utm_y), crs="EPSG:26910")
+    elif geometry and 'x' in timeline.columns and 'y' in timeline.columns:
+        timeline = gpd.GeoDataFrame(timeline, geometry=gpd.points_from_xy(timeline.x, timeline.y))
+        timeline = timeline.set_crs("EPSG:4326").to_crs("EPSG:26910")
+
+    #local (PST) service_date, hour and weekday are stored with the data. Only worked out here if a column list left them out
+    timeline = timeline_store.add_local_time_keys(timeline)
 
     return(timeline)
 
 #Produce a summary of each trip-in-time (i.e. trip X on day Y), with average speed, runtime, etc.
-#Used for the runtimes by time and runtimes by date plots
-def summarize_trip_data(timeline):
+#Used for the runtimes by time and runtimes by date plots. Hover labels are left to trip_labels, for just the trips that get plotted.
+#header_text=False leaves Header as the integer id
+def summarize_trip_data(timeline, header_text = True):
     
     #remove rows with a speed of 0 - speeds up processing and we don't want start/end iddling datapoints
     timeline = timeline[timeline.Speed != 0]
 
-    #Create a new date column, in the format YYYY-MM-DD
-    timeline['Date'] = timeline.Datetime.dt.date
-   
-    #create a new custom_id column, which is the concatenation of the date and trip_id
-    timeline['custom_id'] = timeline['Date'].astype(str) + timeline['Trip ID'].astype(str)
+    #trip-in-time id: the service date (YYYYMMDD) in the high 32 bits and the trip_id in the low 32 bits. Much cheaper to build and group on than a string.
+    #A trip_id outside 0 to 2**32 - 1 would spill into the date bits, so it's refused rather than decoded into the wrong Date
+    trip_ids = timeline['Trip ID'].to_numpy().astype(np.int64)
+    if len(trip_ids) and (trip_ids.min() < 0 or trip_ids.max() >= 2**32):
+        raise ValueError(f"Trip IDs must fit in 32 bits to be packed into trip keys (got {trip_ids.min()} to {trip_ids.max()})")
+    custom_id = (timeline['service_date'].to_numpy().astype(np.int64) << 32) | trip_ids
 
     #aggregate by custom_id, taking the difference between the first and last timestamp. This is the runtime
-    runtimes_df = timeline.groupby(["custom_id"]).agg({"Time": ["min", "max"], 'Date': 'first', 'Route': 'first', 'Header': 'first'}).reset_index()
+    runtimes_df = pd.DataFrame({
+        "custom_id": custom_id,
+        "Time": timeline['Time'].to_numpy().astype(np.int64),
+        "Route": timeline['Route'].to_numpy(),
+        "Header": timeline['Header'].to_numpy(),
+        "weekday": timeline['weekday'].to_numpy()
+    }).groupby("custom_id", sort=True).agg(Time_min=("Time", "min"), Time_max=("Time", "max"), Route=("Route", "first"), Header=("Header", "first"), weekday=("weekday", "first")).reset_index()
+
+    #Date (YYYY-MM-DD) comes back out of the high bits of the id
+    runtimes_df.insert(3, 'Date', pd.to_datetime((runtimes_df['custom_id'].to_numpy() >> 32).astype(str), format='%Y%m%d').date)
+    runtimes_df['runtime'] = (runtimes_df['Time_max'] - runtimes_df['Time_min'])/60
+
+    #the compact timeline has categorical Route/Header. Trips use plain types either way
+    runtimes_df['Route'] = runtimes_df['Route'].astype(str)
+    runtimes_df['Header'] = runtimes_df['Header'].astype(np.int64)
+
+    #remove anything with runtime greater than 200 minutes (extreme outliers) or under 5 minutes
+    runtimes_df = runtimes_df[(runtimes_df.runtime < 200) & (runtimes_df.runtime > 5)]
 
-    runtimes_df['runtime'] = (runtimes_df['Time']['max'] - runtimes_df['Time']['min'])/60
+    #Headers are stored in a separate collection. Look up the header text in the local snapshot of it
+    if header_text:
+        runtimes_df['Header'] = header_names(runtimes_df['Header'])
 
-    #turn two dimensional column names into one dimensional. Just the first element
-    runtimes_df.columns = runtimes_df.columns.get_level_values(0)
+    return(runtimes_df)
 
-    #rename the columns
-    runtimes_df.columns = ['custom_id', 'Time_min', 'Time_max', 'Date', 'Route', 'Header', 'runtime']
+trip_columns = ["Time", "Route", "Header", "Trip ID", "Speed", "service_date", "weekday"]
 
-    #remove anything with runtime greater than 200 minutes (extreme outliers) or under 5 minutes
-    runtimes_df = runtimes_df[(runtimes_df.runtime < 200) & (runtimes_df.runtime > 5)]
+#summarize_trip_data for a single service date partition, run in a worker
+def summarize_partition(service_date):
+    return summarize_trip_data(timeline_store.read_timeline(service_date, service_date, columns=trip_columns), header_text=False)
 
-    #Create label with time_min. This is the time in epoch time
-    runtimes_df['label'] = pd.to_datetime(runtimes_df['Time_min'], unit='s', utc=True)
-    #convert to PST
-    runtimes_df['label'] = runtimes_df['label'].dt.tz_convert('America/Los_Angeles').dt.strftime('%Y-%m-%d %H:%M:%S')
+#summarize_trip_data over a service date window without loading the window: each date partition is loaded and summarised in a
+#worker process and the trips are concatenated (a trip-in-time never spans two dates). Peak memory is one date's pings per worker
+def summarize_partitions(start_date = None, end_date = None, workers = None):
+    trips = render_pool.map_all(summarize_partition, timeline_store.partition_dates(start_date, end_date), workers=workers)
+    if not trips:
+        return summarize_trip_data(pd.DataFrame({column: [] for column in trip_columns}))
+    trips = pd.concat(trips, ignore_index=True)
+
+    #header text is looked up here rather than in the workers, so the lookup snapshot is loaded (and refreshed) once
+    trips['Header'] = header_names(trips['Header'])
+    return trips
 
-    #Headers are stored in a separate collection. Merge the headers with the runtimes_df
-    headers = get_headers_df()
-    runtimes_df = runtimes_df.rename(columns={"Header": "Header_ID"})
+#Departure time label (Pacific) for each trip, from Time_min in epoch time
+def trip_labels(time_min):
+    return pd.to_datetime(time_min, unit='s', utc=True).dt.tz_convert('America/Los_Angeles').dt.strftime('%Y-%m-%d %H:%M:%S')
 
-    runtimes_df['Header_ID'] = runtimes_df['Header_ID']
-    headers['Header_ID'] = headers['Header_ID']
+#The corridor buffers (EPSG:26910) and, as a table of corridor name / Route pairs, the routes whose points count towards each corridor
+def load_corridors():
+    corridors = gpd.read_file("roads/corridors.geojson").set_crs("EPSG:4326").to_crs("EPSG:26910")
 
-    runtimes_df = runtimes_df.merge(headers, on="Header_ID", how="left")
-    runtimes_df = runtimes_df.drop(columns=["Header_ID", "_id"])
+    selected_routes = json.load(open("roads/corridor_routes.json"))
+    corridor_routes = pd.DataFrame([(corridor, route) for corridor, routes in selected_routes.items() for route in routes], columns=["corridor name", "Route"])
 
-    return(runtimes_df)
+    #print an error if a corridor name is not in the selected_routes config
+    for corridor in corridors['corridor name'].unique():
+        if corridor not in selected_routes:
+            print(f"ERROR: Corridor '{corridor}' not found in roads/corridor_routes.json.")
+
+    return corridors, corridor_routes
+
+#Bring the per-file segment, route and corridor speed partials up to date. Only files that haven't been aggregated yet are read,
+#each in its own worker process
+def update_speed_partials(workers = None):
+    timeline_store.convert_csv_to_parquet()
 
-def system_map(timeline):
     route_segments = generate_lines()
- 
-    #create a buffer around each line in lines, and create a new geodataframe with the buffers
-    route_segments['line_geom'] = route_segments['geometry']
-    route_segments['geometry'] = route_segments.buffer(20, cap_style=2)
     route_segments['buffer_id'] = route_segments.index
-    timeline['Hour'] = timeline.Datetime.dt.hour
+    corridors, corridor_routes = load_corridors()
 
-    #spatial merge. Find all the points that are within buffers, and retain buffer geometry.
-    timeline = gpd.sjoin(route_segments, timeline, how="left", predicate="intersects")
-    
-    timeline['geometry'] = timeline['line_geom']
-    timeline = timeline[["Hour", "Speed", "buffer_id", "geometry"]]
+    speed_partials.update_all(route_segments, corridors, corridor_routes, workers)
+    return
+
+#Service date window for the charts built from partials and sketches. Same rule as retrieve_timeline: the file_limit most recent files unless dates are given
+def date_window(file_limit = 3, start_date = None, end_date = None):
+    if start_date is None and end_date is None:
+        return timeline_store.recent_start_date(file_limit), None
+    start_date = None if start_date is None else timeline_store.date_key(start_date)
+    end_date = None if end_date is None else timeline_store.date_key(end_date)
+    return start_date, end_date
+
+#Speed sum and count by segment, weekday and hour over the window, added up from the partials. All three system maps are derived from this
+def segment_speed_cube(file_limit = 3, start_date = None, end_date = None, update = True):
+    if update:
+        update_speed_partials()
+    start_date, end_date = date_window(file_limit, start_date, end_date)
+
+    cube = cube_from_partials(speed_partials.merge_partials("segment", start_date, end_date, by=["weekday", "hour"]))
+    save_speed_cube(cube, start_date, end_date)
+    return cube
+
+#The system maps, from the speed partials. update=False skips checking for new files (the pipeline updates them in its own stage)
+def system_map(file_limit = 3, start_date = None, end_date = None, cube = None, update = True):
+    import keplergl
+
+    route_segments = generate_lines()
+    route_segments['buffer_id'] = route_segments.index
+
+    if cube is None:
+        cube = segment_speed_cube(file_limit, start_date, end_date, update)
+
+    segments = route_segments[["buffer_id", "geometry"]]
 
     #aggregate data and create maps with kepler.gl
     
-    #system speed map
-    gdf = timeline.groupby(["buffer_id"]).agg({"Speed": "mean", "geometry": "first"}).reset_index()
+    #system speed map. Segments without any points are kept (with no speed)
+    gdf = segments.merge(mean_speed(cube), left_on="buffer_id", right_index=True, how="left")
+    gdf = gdf[["buffer_id", "Speed", "geometry"]]
     gdf = gpd.GeoDataFrame(gdf, geometry="geometry", crs="EPSG:26910")
     gdf = gdf.to_crs("WGS-84")
     gdf['Speed Data'] = gdf['Speed'].round(1)
@@ -117,8 +187,8 @@ def system_map(timeline):
         
     #system peak sped map
     #restrict to between 8am and 11am
-    gdf = timeline[(timeline.Hour == 8) | (timeline.Hour == 9) | (timeline.Hour == 10)]
-    gdf = gdf.groupby(["buffer_id"]).agg({"Speed": "mean", "geometry": "first"}).reset_index()
+    gdf = segments.merge(mean_speed(cube, hours=[8, 9, 10]), left_on="buffer_id", right_index=True, how="inner")
+    gdf = gdf[["buffer_id", "Speed", "geometry"]]
     gdf = gpd.GeoDataFrame(gdf, geometry="geometry", crs="EPSG:26910")
     gdf = gdf.to_crs("WGS-84")
     gdf['Speed Data'] = gdf['Speed'].round(1)
@@ -130,21 +200,8 @@ def system_map(timeline):
     map_1.save_to_html(file_name="docs/plots/system_speed_peak_map.html", config=kepler_config, read_only=True)
 
     #system peak vs off-peak speed map
-
-    gdf = timeline.pivot_table(index=["buffer_id"], columns="Hour", values="Speed", aggfunc="mean").reset_index()
-    gdf = gdf.merge(timeline[["buffer_id", "geometry"]].drop_duplicates(subset=["buffer_id"]), on="buffer_id", how="left")
-    #calculate a three-hour-window moving average to identify the peak and off-peak speeds
-    for i in range(1, 22): #centres of the different windows
-        gdf["{}-{}-{}".format(i-1, i, i+1)] = gdf[[i-1, i, i+1]].mean(axis=1)
-    #for each row, identify the highest and lowest values of these windows
-    cols_to_analyze = gdf.loc[:, "0-1-2":"20-21-22"]
-    gdf['Peak'] = cols_to_analyze.min(axis=1).round(1)
-    gdf['Peak Hour'] = cols_to_analyze.idxmin(axis=1)
-    gdf['Off-Peak'] = cols_to_analyze.max(axis=1).round(1)
-    gdf['Off-Peak Hour'] = cols_to_analyze.idxmax(axis=1)
-
-    gdf['Speed Delta'] = gdf['Off-Peak'] - gdf['Peak']
-
+    #three-hour-window averages identify the peak (slowest) and off-peak (fastest) speeds
+    gdf = segments.merge(peak_delta(cube), left_on="buffer_id", right_index=True, how="inner")
     gdf = gdf[["buffer_id", "geometry", "Peak", "Peak Hour", "Off-Peak", "Off-Peak Hour", "Speed Delta"]]
     gdf = gpd.GeoDataFrame(gdf, geometry="geometry", crs="EPSG:26910")
     gdf = gdf.to_crs("WGS-84")
@@ -159,10 +216,17 @@ def system_map(timeline):
     return
 
 def dot_map(gdf):
-    if len(gdf) >= 150000:
-        gdf = gdf.sample(n=150000)
+    import keplergl
+
+    #copy when not sampling, so the caller's timeline isn't modified
+    gdf = gdf.sample(n=150000) if len(gdf) >= 150000 else gdf.copy()
+
+    #points for the sampled pings only, if the timeline was loaded without geometry
+    if 'geometry' not in gdf.columns:
+        gdf = gpd.GeoDataFrame(gdf, geometry=timeline_store.ping_points(gdf), crs="EPSG:26910")
 
-    gdf['Datetime'] = gdf['Datetime'].dt.strftime('%Y-%m-%d %H:%M:%S').astype(str)
+    #local time, for the sampled points only
+    gdf['Datetime'] = pd.to_datetime(gdf['Time'], unit='s', utc=True).dt.tz_convert('America/Los_Angeles').dt.strftime('%Y-%m-%d %H:%M:%S').astype(str)
 
     #round speed to 1 decimal place
     gdf.Speed = gdf.Speed.round(1)
@@ -177,50 +241,24 @@ def dot_map(gdf):
 
     return
 
-def corridor_map(timeline):
-    corridors = gpd.read_file("roads/corridors.geojson").set_crs("EPSG:4326").to_crs("EPSG:26910")
-    timeline['Hour'] = timeline.Datetime.dt.hour
-    timeline = timeline[(timeline.Hour == 8) | (timeline.Hour == 9) | (timeline.Hour == 10)]
-
-    corridors['Average Speed'] = 0
+#Average 8am-11am speed along each corridor, from the corridor speed partials
+def corridor_map(file_limit = 3, start_date = None, end_date = None, update = True):
+    import keplergl
 
-    # New selected_routes dictionary with similar formatting and same routes
-    selected_routes = {
-        "Mckenzie East": ["26"],
-        "Mckenzie Centre": ["26"],
-        "Mckenzie Quadra": ["26"],
-        "Fort West": ["14", "15", "11"],
-        "Fort East": ["14", "15", "11"],
-        "Foul Bay": ["7", "15"],
-        "Hillside": ["4"],
-        "Quadra": ["6"],
-        "Douglas South": ["95"],
-        "Douglas North": ["95"],
-        "Pandora West": ["2", "5", "27", "28"],
-        "Pandora East": ["2", "5", "27", "28"],
-        "Oak Bay": ["2", "5"],
-        "Johnson": ["2", "5", "27", "28"],
-        "Shelbourne South": ["27", "28"],
-        "Shelbourne North": ["27", "28"]
-    }
-    
-    for corridor in corridors['corridor name'].unique():
-        #print an error if the corridor name is not in the selected_routes dictionary
-        if corridor not in selected_routes:
-            print(f"ERROR: Corridor '{corridor}' not found in selected_routes dictionary.")
-            continue
+    if update:
+        update_speed_partials()
+    start_date, end_date = date_window(file_limit, start_date, end_date)
 
-        filtered_timeline = timeline[timeline.Route.isin(selected_routes[corridor])].reset_index()
-        buffer = corridors[corridors['corridor name'] == corridor].buffer(20, cap_style=2)
-        buffer = gpd.GeoDataFrame(buffer, geometry=buffer, crs="EPSG:26910")
+    corridors, corridor_routes = load_corridors()
+    corridors['Average Speed'] = 0
 
-        #filter timeline to only include points within buffer
-        filtered_timeline = filtered_timeline[filtered_timeline.geometry.within(buffer.unary_union)]
+    #points within each corridor's buffer, from the routes that serve it. Assigned once per file when the partials are built
+    speeds = speed_partials.speed_stats(speed_partials.merge_partials("corridor", start_date, end_date, hours=[8, 9, 10]))
 
-        #calculate average speed and update corridor dataframd
-        avg_speed = filtered_timeline.Speed.mean()
-        avg_speed = round(avg_speed, 1)
-        corridors.loc[corridors['corridor name'] == corridor, "Average Speed"] = avg_speed
+    #calculate average speed and update corridor dataframe
+    avg_speed = speeds.set_index("corridor name").Speed.round(1)
+    in_config = corridors['corridor name'].isin(corridor_routes['corridor name'])
+    corridors.loc[in_config, "Average Speed"] = corridors.loc[in_config, 'corridor name'].map(avg_speed)
 
     corridors = corridors.to_crs("EPSG:4326")
 
@@ -234,16 +272,17 @@ def corridor_map(timeline):
     
     return
 
-def all_routes_bar_chart(timeline):
+#Average 8am-11am speed of each route, from the route speed partials
+def all_routes_bar_chart(file_limit = 3, start_date = None, end_date = None, update = True):
+    px, go = load_plotly()
+    if update:
+        update_speed_partials()
+    start_date, end_date = date_window(file_limit, start_date, end_date)
 
-    timeline['Hour'] = timeline.Datetime.dt.hour
-    timeline = timeline[(timeline.Hour == 8) | (timeline.Hour == 9) | (timeline.Hour == 10)]
-    timeline.Route = timeline.Route.astype(str)
-
-    pivot = pd.pivot_table(timeline, values='Speed', index='Route', aggfunc='mean')
+    pivot = speed_partials.speed_stats(speed_partials.merge_partials("route", start_date, end_date, hours=[8, 9, 10]))[["Route", "Speed"]]
 
     #order by speed, highest to lowest
-    pivot = pivot.sort_values(by='Speed', ascending=True).reset_index()
+    pivot = pivot.sort_values(by='Speed', ascending=True).reset_index(drop=True)
 
     #set timeline.Frequency to one of Local, FTN, RTN
     pivot['Frequency'] = "Local"
@@ -264,12 +303,17 @@ def all_routes_bar_chart(timeline):
 
     return
 
-def runtimes_by_time(timeline):
-    trips = summarize_trip_data(timeline)
+#Runtime by departure time over the last 30 days. With no timeline, the trips are summarised partition by partition
+#(summarize_partitions) over the file_limit most recent files or the given dates
+def runtimes_by_time(timeline = None, file_limit = 3, start_date = None, end_date = None, workers = None):
+    if timeline is None:
+        trips = summarize_partitions(*date_window(file_limit, start_date, end_date), workers=workers)
+    else:
+        trips = summarize_trip_data(timeline)
     #only use data from the last 30 days
     trips = trips[trips.Date >= trips.Date.max() - pd.Timedelta(days=30)]
-    #only pick trips that were on a weekday - use time_min (currently in epoch time) to get the day of the week. Will need to turn epoch to datetime
-    trips = trips[trips.Time_min.apply(lambda x: pd.to_datetime(x, unit='s').weekday() < 5)]
+    #only pick trips that were on a weekday (local service date)
+    trips = trips[trips.weekday < 5]
 
     #convert time_min to datetime. Data is epoch time, datetime needs to be i  -n PST
     trips['Time-only'] = pd.to_datetime(trips['Time_min'], unit='s', utc=True)
@@ -288,115 +332,129 @@ def runtimes_by_time(timeline):
     #round runtime to 1 decimal place
     trips['runtime'] = trips['runtime'].round(1)
 
-    for route in trips.Route.unique():
-        fig = go.Figure()
-        route_trips = trips[trips.Route == route]
-        for i in range(0, len(route_trips.Header.unique())):
-            header = trips[trips.Route == route].Header.unique()[i]
-            colour = px.colors.qualitative.Plotly[i]
+    #hover labels, only for the trips that are plotted
+    trips['label'] = trip_labels(trips['Time_min'])
 
-            df = route_trips[route_trips.Header == header]
+    #one figure per route, rendered in parallel. Each job only carries its own route's trips
+    jobs = [(route, route_trips) for route, route_trips in trips.groupby('Route', sort=False)]
+    render_pool.render_all(render_runtime_by_time, jobs, workers=workers)
 
-            #calculate 5th and 95th percentile using a central moving average
-            df['y_5th_perc'] = df.runtime.rolling(window=10, min_periods=1, center=True).apply(lambda x: np.percentile(x, 5), raw=True)
-            df['y_95th_perc'] = df.runtime.rolling(window=10, min_periods=1, center=True).apply(lambda x: np.percentile(x, 95), raw=True)
+    return
 
-            x = df['Time-only'].astype('int64') // 10**9
-            
-            lowess = sm.nonparametric.lowess(df.runtime, x, frac=.3)
-            lowess_5th_perc = sm.nonparametric.lowess(df.y_5th_perc, x, frac=.3)
-            lowess_95th_perc = sm.nonparametric.lowess(df.y_95th_perc, x, frac=.3)
-
-            y = lowess[:, 1]
-            y_5th_perc = lowess_5th_perc[:, 1]
-            y_95th_perc = lowess_95th_perc[:, 1]
-
-            x=lowess[:, 0],
-            x = pd.to_datetime(lowess[:, 0], unit='s')
-
-            #add 5th and 95th percentile lines
-            fig.add_trace(go.Scatter
-            (
-                x=x,
-                y=y_5th_perc,
-                mode='lines',
-                name=f'{header} 5th Percentile',
-                marker=dict(color=colour),
-                line=dict(color=colour, width=1),
-                hoverinfo='skip',
-                showlegend=False
-            ))
+def render_runtime_by_time(job):
+    px, go = load_plotly()
+    route, route_trips = job
+    fig = go.Figure()
+    for i in range(0, len(route_trips.Header.unique())):
+        header = route_trips.Header.unique()[i]
+        colour = px.colors.qualitative.Plotly[i]
 
-            fig.add_trace(go.Scatter
-            (
-                x=x,
-                y=y_95th_perc,
-                mode='lines',
-                name=f'{header} 95th Percentile',
-                marker=dict(color=colour),
-                line=dict(color=colour, width=1),
-                hoverinfo='skip',
-                fill='tonexty',
-                fillcolor=f'rgba({int(colour[1:3], 16)}, {int(colour[3:5], 16)}, {int(colour[5:7], 16)}, 0.1)',
-                showlegend=False
-            ))
+        df = route_trips[route_trips.Header == header]
 
-            fig.add_trace(go.Scatter(
-                x=x,
-                y=y,
-                mode='lines',
-                name=f'{header} LOWESS',
-                marker=dict(color=colour),
-                line=dict(color=colour, width=2),
-                showlegend=False
-                
-            ))
+        #calculate 5th and 95th percentile using a central moving window
+        df['y_5th_perc'] = rolling_percentile(df.runtime, 5, window=10)
+        df['y_95th_perc'] = rolling_percentile(df.runtime, 95, window=10)
 
-            fig.add_trace(go.Scatter(
-                x=df['Time-only'], 
-                y=df.runtime, 
-                mode='markers', 
-                name=header, 
-                marker=dict(color=colour, opacity=0.5), 
-                customdata=df[['Route', 'label', 'Header']],
-                hovertemplate="<b>Runtime: %{y} minutes</b><br>Direction: %{customdata[2]}<br>Departure: %{customdata[1]}<br>Route: %{customdata[0]}<extra></extra>"
-            ))
-            
-        fig.update_layout(legend=dict(
-                    yanchor="top",
-                    y=0.99,
-                    xanchor="right",
-                    x=.99
-                ))
+        x = df['Time-only'].astype('int64') // 10**9
         
-        #add title, center it
-        fig.update_layout(title='Route {} Runtimes by Time'.format(route),
-                xaxis_title='Time',
-                yaxis_title='Runtime (minutes)',
-                title_x=0.5)
+        lowess_runtime = lowess(df.runtime, x, frac=.3, delta_fraction=lowess_delta_fraction)
+        lowess_5th_perc = lowess(df.y_5th_perc, x, frac=.3, delta_fraction=lowess_delta_fraction)
+        lowess_95th_perc = lowess(df.y_95th_perc, x, frac=.3, delta_fraction=lowess_delta_fraction)
+
+        y = lowess_runtime[:, 1]
+        y_5th_perc = lowess_5th_perc[:, 1]
+        y_95th_perc = lowess_95th_perc[:, 1]
+
+        x = pd.to_datetime(lowess_runtime[:, 0], unit='s')
+
+        #add 5th and 95th percentile lines
+        fig.add_trace(go.Scatter
+        (
+            x=x,
+            y=y_5th_perc,
+            mode='lines',
+            name=f'{header} 5th Percentile',
+            marker=dict(color=colour),
+            line=dict(color=colour, width=1),
+            hoverinfo='skip',
+            showlegend=False
+        ))
+
+        fig.add_trace(go.Scatter
+        (
+            x=x,
+            y=y_95th_perc,
+            mode='lines',
+            name=f'{header} 95th Percentile',
+            marker=dict(color=colour),
+            line=dict(color=colour, width=1),
+            hoverinfo='skip',
+            fill='tonexty',
+            fillcolor=f'rgba({int(colour[1:3], 16)}, {int(colour[3:5], 16)}, {int(colour[5:7], 16)}, 0.1)',
+            showlegend=False
+        ))
+
+        fig.add_trace(go.Scatter(
+            x=x,
+            y=y,
+            mode='lines',
+            name=f'{header} LOWESS',
+            marker=dict(color=colour),
+            line=dict(color=colour, width=2),
+            showlegend=False
+            
+        ))
+
+        fig.add_trace(go.Scatter(
+            x=df['Time-only'], 
+            y=df.runtime, 
+            mode='markers', 
+            name=header, 
+            marker=dict(color=colour, opacity=0.5), 
+            customdata=df[['Route', 'label', 'Header']],
+            hovertemplate="<b>Runtime: %{y} minutes</b><br>Direction: %{customdata[2]}<br>Departure: %{customdata[1]}<br>Route: %{customdata[0]}<extra></extra>"
+        ))
         
-        fig.add_annotation(text="5th and 95th Percentiles Shown", xref="paper", yref="paper", x=0.5, y=0.05, showarrow=False)
+    fig.update_layout(legend=dict(
+                yanchor="top",
+                y=0.99,
+                xanchor="right",
+                x=.99
+            ))
+    
+    #add title, center it
+    fig.update_layout(title='Route {} Runtimes by Time'.format(route),
+            xaxis_title='Time',
+            yaxis_title='Runtime (minutes)',
+            title_x=0.5)
+    
+    fig.add_annotation(text="5th and 95th Percentiles Shown", xref="paper", yref="paper", x=0.5, y=0.05, showarrow=False)
 
-        fig.write_html("docs/plots/runtime_by_time/route " + str(route) + ".html")
+    fig.write_html("docs/plots/runtime_by_time/route " + str(route) + ".html")
 
-    return  
+    return
 
-def runtimes_by_date(timeline):
-    trips = summarize_trip_data(timeline)
+#Trip runtime sketches for every service date in the store, so runtime percentiles for any date range don't need the pings
+def update_runtime_sketches(workers = None):
+    timeline_store.convert_csv_to_parquet()
+    runtime_sketches.update_sketches(functools.partial(summarize_trip_data, header_text=False), workers)
+    return
 
-    #turn trips Time_min into a datetime object
-    trips['Time_min'] = pd.to_datetime(trips['Time_min'], unit='s', utc=True)
-    #convert to PST
-    trips['Time_min'] = trips['Time_min'].dt.tz_convert('America/Los_Angeles')
+#Median and 5th/95th percentile runtime per date and route, from the runtime sketches (exact, see runtime_sketches.py).
+#Window: the file_limit most recent files unless dates are given. update=False skips checking for new files
+def runtimes_by_date(file_limit = 100, start_date = None, end_date = None, workers = None, update = True):
+    if update:
+        update_runtime_sketches()
+    start_date, end_date = date_window(file_limit, start_date, end_date)
 
-    #aggregate by date, Route. Get the average runtime, bot percentile, and top percentile. Use groupby, agg, and lambda functions
-    runtimes_df = trips.groupby(['Date', 'Route']).agg({'runtime': ['median', lambda x: np.percentile(x, 5), lambda x: np.percentile(x, 95)]}).reset_index()
+    runtimes_df = runtime_sketches.runtime_percentiles([50, 5, 95], start_date, end_date, by=["service_date", "Route"])
+    runtimes_df = runtimes_df.drop(columns="trips")
 
     #columns
     runtimes_df.columns = ['Date', 'Route', 'mean_runtime', 'bot_percentile', 'top_percentile']
     
     #create datetime object from date
-    runtimes_df['Date'] = pd.to_datetime(runtimes_df['Date'])
+    runtimes_df['Date'] = pd.to_datetime(runtimes_df['Date'].astype(str), format='%Y%m%d')
 
     #sort low to high
     runtimes_df = runtimes_df.sort_values(by='Date')
@@ -406,54 +464,64 @@ def runtimes_by_date(timeline):
     runtimes_df['bot_percentile'] = runtimes_df['bot_percentile'].round(2)
     runtimes_df['top_percentile'] = runtimes_df['top_percentile'].round(2)
 
+    #a fixed tenth of the trips, kept with the sketches
+    trips = runtime_sketches.read_samples(start_date, end_date)
     trips['runtime'] = trips['runtime'].round(2)
-    trips = trips.sample(frac=0.1, random_state=1)
 
-    for route in runtimes_df.Route.unique():
-        df = runtimes_df[runtimes_df.Route == route]
-        fig = go.Figure()
+    #turn trips Time_min into a datetime object
+    trips['Time_min'] = pd.to_datetime(trips['Time_min'], unit='s', utc=True)
+    #convert to PST
+    trips['Time_min'] = trips['Time_min'].dt.tz_convert('America/Los_Angeles')
 
-        colour = px.colors.qualitative.Plotly[0]
+    #one figure per route, rendered in parallel. The sampled trips are drawn on every figure, so they're sent to each worker once
+    jobs = [(route, df) for route, df in runtimes_df.groupby('Route', sort=False)]
+    render_pool.render_all(render_runtime_by_date, jobs, shared_data=trips, workers=workers)
 
-        #scatter plot of the data with hover disabled for trips
-        fig.add_trace(go.Scatter(
-            x=trips.Time_min, 
-            y=trips.runtime, 
-            mode='markers', 
-            name=str(route), 
-            marker=dict(color=colour, opacity=0.25), 
-            showlegend=False,
-            hoverinfo='skip'
-            ))
+    return
 
-        fig.add_trace(go.Scatter(x=df.Date,
-                     y=df.mean_runtime,
-                     mode='lines',
-                     name="Route " + str(df.Route.iloc[0]),
-                     marker=dict(color='darkblue'),
-                     hovertemplate="<b>Mean Runtime: %{y} minutes</b><br>Date: %{x}"))
-     
-        fig.update_layout(title='Route {} Runtime by Date'.format(df.Route.iloc[0]),
-                        xaxis_title='Date',
-                        yaxis_title='Mean Runtime (minutes)')
-        
-        #centre title
-        fig.update_layout(title_x=0.5)
+def render_runtime_by_date(job):
+    px, go = load_plotly()
+    route, df = job
+    trips = render_pool.shared
+    fig = go.Figure()
+
+    colour = px.colors.qualitative.Plotly[0]
+
+    #scatter plot of the data with hover disabled for trips
+    fig.add_trace(go.Scatter(
+        x=trips.Time_min, 
+        y=trips.runtime, 
+        mode='markers', 
+        name=str(route), 
+        marker=dict(color=colour, opacity=0.25), 
+        showlegend=False,
+        hoverinfo='skip'
+        ))
+
+    fig.add_trace(go.Scatter(x=df.Date,
+                 y=df.mean_runtime,
+                 mode='lines',
+                 name="Route " + str(df.Route.iloc[0]),
+                 marker=dict(color='darkblue'),
+                 hovertemplate="<b>Mean Runtime: %{y} minutes</b><br>Date: %{x}"))
+ 
+    fig.update_layout(title='Route {} Runtime by Date'.format(df.Route.iloc[0]),
+                    xaxis_title='Date',
+                    yaxis_title='Mean Runtime (minutes)')
+    
+    #centre title
+    fig.update_layout(title_x=0.5)
 
-        fig.write_html("docs/plots/runtime_by_date/route " + str(route) + ".html")
+    fig.write_html("docs/plots/runtime_by_date/route " + str(route) + ".html")
 
     return
 
-#run all functions
-def run_all():
-    timeline = retrieve_timeline(3)
-
-    #system_map(timeline)
-    #dot_map(timeline)
-    corridor_map(timeline)
-    """all_routes_bar_chart(timeline)
-    runtimes_by_time(timeline)
-    runtimes_by_date(retrieve_timeline(100))"""
+#Build every output, skipping whatever hasn't changed since the last run. Stages and their inputs are defined in pipeline.py
+def run_all(targets = None, force = False):
+    import pipeline
+    pipeline.run(targets, force=force)
     return
 
-run_all()
\ No newline at end of file
+#worker processes re-import this module, so only run when called directly
+if __name__ == "__main__":
+    run_all()
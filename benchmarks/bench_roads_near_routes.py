@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+
+import numpy as np
+import shapely
+import geopandas as gpd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from create_shapes import roads_near_routes
+
+#Selecting the road segments that run along a bus route (create_shapes.filter_roads, behind generate_lines): the per-road
+#probe point applies and three sjoins it used to do, against roads_near_routes' vectorized probes and single STRtree query.
+#Synthetic roads and route segments over a 20km square in EPSG:26910. Usage: python benchmarks/bench_roads_near_routes.py [roads] [route segments]
+def random_lines(count, length, rng):
+    start = rng.uniform(0, 20000, (count, 2))
+    angle = rng.uniform(0, 2 * np.pi, count)
+    end = start + length * np.column_stack([np.cos(angle), np.sin(angle)])
+    middle = (start + end) / 2 + rng.normal(0, length / 10, (count, 2))
+    return gpd.GeoDataFrame(geometry=shapely.linestrings(np.stack([start, middle, end], axis=1)), crs="EPSG:26910")
+
+#the selection as filter_roads made it before roads_near_routes
+def roads_near_routes_sjoin(roads, route_map, buffer_distance = 20):
+    roads = roads.copy()
+    roads['road_id'] = roads.index
+
+    common_ids = None
+    for probe in [lambda x: shapely.Point(x.coords[0]), lambda x: x.interpolate(0.5, normalized=True), lambda x: shapely.Point(x.coords[-1])]:
+        points = gpd.GeoDataFrame({'road_id': roads['road_id'], 'geometry': roads.geometry.apply(probe)}, crs=roads.crs)
+        points.geometry = points.buffer(buffer_distance)
+        ids = set(gpd.sjoin(points, route_map, how="inner", predicate="intersects").road_id.unique())
+        common_ids = ids if common_ids is None else common_ids & ids
+
+    return roads['road_id'].isin(common_ids).to_numpy()
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    road_count = int(sys.argv[1]) if len(sys.argv) > 1 else 60000
+    segment_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    rng = np.random.default_rng(0)
+    roads = random_lines(road_count, 150, rng)
+    route_map = random_lines(segment_count, 400, rng)
+
+    old, old_time = timed(roads_near_routes_sjoin, roads, route_map)
+    new, new_time = timed(roads_near_routes, roads, route_map)
+
+    print(f"{road_count} roads, {segment_count} route segments")
+    print(f"apply + sjoin:      {old_time:.2f}s")
+    print(f"roads_near_routes:  {new_time:.2f}s ({old_time / new_time:.1f}x)")
+    print(f"roads kept: {old.sum()} / {new.sum()}, same selection: {np.array_equal(old, new)}")
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from analysis import summarize_trip_data, trip_labels
+
+#Summarising pings into trips-in-time (analysis.summarize_trip_data): the date + trip_id string key and per-trip hover labels
+#it used to build, against the packed integer key with labels left to trip_labels. Header text lookup is left out of both.
+#Synthetic pings over consecutive service dates. Usage: python benchmarks/bench_trip_keys.py [pings] [days]
+def synthetic_timeline(ping_count, day_count, rng):
+    trips_per_day = 1500
+    day = rng.integers(0, day_count, ping_count)
+    trip = rng.integers(0, trips_per_day, ping_count)
+    service_date = pd.Timestamp("2024-09-01") + pd.to_timedelta(day, unit="D")
+    #each trip runs for up to about an hour from its own departure time
+    departure = pd.Timestamp("2024-09-01 12:00", tz="UTC").value // 10**9 + day * 86400 + trip * 40
+    return pd.DataFrame({
+        "Time": (departure + rng.integers(0, 3600, ping_count)).astype(np.int32),
+        "Route": pd.Categorical((trip % 60).astype(str)),
+        "Header": (trip % 200).astype(np.int32),
+        "Trip ID": (trip + 10**6).astype(np.int32),
+        "Speed": rng.uniform(0, 50, ping_count).astype(np.float32),
+        "service_date": (service_date.year * 10000 + service_date.month * 100 + service_date.day).to_numpy().astype(np.int32),
+        "weekday": service_date.weekday.to_numpy().astype(np.int8)
+    })
+
+#summarize_trip_data as it was before the packed keys, including the label it built for every trip
+def summarize_with_string_keys(timeline):
+    timeline = timeline[timeline.Speed != 0].copy()
+    timeline['Date'] = pd.to_datetime(timeline['service_date'].astype(str), format='%Y%m%d').dt.date
+    timeline['custom_id'] = timeline['Date'].astype(str) + timeline['Trip ID'].astype(str)
+
+    runtimes_df = timeline.groupby(["custom_id"]).agg({"Time": ["min", "max"], 'Date': 'first', 'Route': 'first', 'Header': 'first', 'weekday': 'first'}).reset_index()
+    runtimes_df.columns = ['custom_id', 'Time_min', 'Time_max', 'Date', 'Route', 'Header', 'weekday']
+    runtimes_df['runtime'] = (runtimes_df['Time_max'] - runtimes_df['Time_min'])/60
+
+    runtimes_df['Route'] = runtimes_df['Route'].astype(str)
+    runtimes_df['Header'] = runtimes_df['Header'].astype(np.int64)
+    runtimes_df['Time_min'] = runtimes_df['Time_min'].astype(np.int64)
+    runtimes_df['Time_max'] = runtimes_df['Time_max'].astype(np.int64)
+    runtimes_df = runtimes_df[(runtimes_df.runtime < 200) & (runtimes_df.runtime > 5)]
+
+    runtimes_df['label'] = pd.to_datetime(runtimes_df['Time_min'], unit='s', utc=True).dt.tz_convert('America/Los_Angeles').dt.strftime('%Y-%m-%d %H:%M:%S')
+    return runtimes_df
+
+#summarize_trip_data, then labels for the last 7 days only (runtimes_by_time labels just the trips it plots)
+def summarize_with_packed_keys(timeline):
+    trips = summarize_trip_data(timeline, header_text=False)
+    plotted = trips[trips.Date >= trips.Date.max() - pd.Timedelta(days=7)]
+    return trips, trip_labels(plotted['Time_min'])
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    ping_count = int(sys.argv[1]) if len(sys.argv) > 1 else 3000000
+    day_count = int(sys.argv[2]) if len(sys.argv) > 2 else 21
+    timeline = synthetic_timeline(ping_count, day_count, np.random.default_rng(0))
+
+    old, old_time = timed(summarize_with_string_keys, timeline)
+    (new, labels), new_time = timed(summarize_with_packed_keys, timeline)
+
+    #same trips in the same order (the string key sorts by date, then trip_id as text, which is numeric order for equal-length ids)
+    columns = ['Time_min', 'Time_max', 'Date', 'Route', 'Header', 'weekday', 'runtime']
+    same = old[columns].reset_index(drop=True).equals(new[columns].reset_index(drop=True))
+
+    print(f"{ping_count} pings over {day_count} days, {len(new)} trips, {len(labels)} labelled")
+    print(f"string keys, every label:  {old_time:.2f}s")
+    print(f"packed keys, lazy labels:  {new_time:.2f}s ({old_time / new_time:.1f}x)")
+    print(f"same trips: {same}")
@@ -0,0 +1,42 @@
+import os
+import json
+import shutil
+import hashlib
+
+#Everything derived from the raw inputs lives under cache/ and can be deleted at any time
+cache_folder = "cache"
+
+#sha1 of a file's contents, read in blocks so large feeds aren't loaded into memory
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+#Combine input hashes and parameters into a single key. Any change to any part gives a new key
+def cache_key(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+#Path for a cache entry, creating its folder if needed
+def cache_path(name, key, extension = "parquet"):
+    folder = os.path.join(cache_folder, name)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, key + "." + extension)
+
+#Remove every entry of a cache except the current one, so stale versions don't pile up.
+#Entries another process has already removed are skipped
+def prune_cache(name, keep):
+    folder = os.path.join(cache_folder, name)
+    for file in os.listdir(folder):
+        if file.startswith(keep):
+            continue
+        path = os.path.join(folder, file)
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+    return
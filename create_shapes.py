@@ -1,43 +1,67 @@
-from shapely.geometry import Point
+import os
+
+import numpy as np
+import shapely
 import geopandas as gpd
-from gtfs_functions import Feed
 
-def generate_lines():
-    feed = Feed("static/gtfs.zip")
+from cache_utils import file_hash, cache_key, cache_path, prune_cache
+from gtfs_tables import feed_version, open_feed, load_route_lines
+
+gtfs_path = "static/gtfs.zip"
+roads_path = "roads/raw_download.geojson"
+
+#Road segments that run along a bus route. The result only depends on the GTFS feed, the road layer and the buffer distance,
+#so it's cached on disk under a key built from all three and only recomputed when one of them changes.
+#Bump the version string when filter_roads or roads_near_routes change which roads are kept (v2: matched against the
+#first-to-last-stop route lines instead of the feed's segments)
+def generate_lines(buffer_distance = 20, use_cache = True):
+    key = cache_key("road segments v2", feed_version(gtfs_path), file_hash(roads_path), buffer_distance)
+    path = cache_path("road_segments", key)
+
+    if use_cache and os.path.exists(path):
+        return gpd.read_parquet(path)
+
+    roads = filter_roads(buffer_distance)
+
+    roads.to_parquet(path, index=True)
+    prune_cache("road_segments", key)
+
+    return roads
 
-    roads = gpd.read_file("roads/raw_download.geojson")
+def filter_roads(buffer_distance = 20):
+    roads = gpd.read_file(roads_path)
     roads = roads.to_crs("EPSG:26910")
 
-    #get route map
-    route_map = feed.segments.to_crs("EPSG:26910")
+    #get route map: every shape with trips, from its first stop to its last (prebuilt in the GTFS cache)
+    route_map = load_route_lines(open_feed(gtfs_path))
 
     #filter roads to ensure we're only analyzing roads near route_map
     roads['road_id'] = roads.index
+    roads = roads[roads_near_routes(roads, route_map, buffer_distance)]
+
+    return roads
+
+#Mask of roads whose start, mid and end points are all within buffer_distance of a route segment.
+#All three probe points for every road are buffered in one pass and tested against a single STRtree of the route segments
+def roads_near_routes(roads, route_map, buffer_distance = 20):
+    geometry = roads.geometry.to_numpy()
+    n = len(geometry)
+
+    #probes [0, n) are start points, [n, 2n) mid points and [2n, 3n) end points
+    probes = np.concatenate([
+        shapely.get_point(geometry, 0),
+        shapely.line_interpolate_point(geometry, 0.5, normalized=True),
+        shapely.get_point(geometry, -1)
+    ])
+    #quad_segs=16 matches GeoSeries.buffer, so the selection is identical to buffering with geopandas
+    probes = shapely.buffer(probes, buffer_distance, quad_segs=16)
+
+    tree = shapely.STRtree(route_map.geometry.to_numpy())
+    probe_idx, _ = tree.query(probes, predicate="intersects")
+
+    #a road is kept if each of its three probes hit at least one segment
+    hit_probes = np.unique(probe_idx)
+    hits_per_road = np.bincount(hit_probes % n, minlength=n)
+
+    return hits_per_road == 3
 
-    # Create GeoDataFrames for start and end points
-    start_pts = roads.geometry.apply(lambda x: x.coords[0])
-    mid_pts = roads.geometry.apply(lambda x: x.interpolate(0.5, normalized=True))
-    end_pts = roads.geometry.apply(lambda x: x.coords[-1])
-    start_gdf = gpd.GeoDataFrame({'road_id': roads['road_id'], 'geometry': start_pts.apply(lambda x: Point(x))}, crs=roads.crs)
-    mid_gdf = gpd.GeoDataFrame({'road_id': roads['road_id'], 'geometry': mid_pts.apply(lambda x: Point(x))}, crs=roads.crs)
-    end_gdf = gpd.GeoDataFrame({'road_id': roads['road_id'], 'geometry': end_pts.apply(lambda x: Point(x))}, crs=roads.crs)
-
-    start_gdf.geometry = start_gdf.buffer(20)
-    mid_gdf.geometry = mid_gdf.buffer(20)
-    end_gdf.geometry = end_gdf.buffer(20)
-
-    start_gdf = gpd.sjoin(start_gdf, route_map, how="inner", predicate="intersects")
-    mid_gdf = gpd.sjoin(mid_gdf, route_map, how="inner", predicate="intersects")
-    end_gdf = gpd.sjoin(end_gdf, route_map, how="inner", predicate="intersects")
-
-    #get a list of buffer_ids that appear in both start and end gdf
-    start_ids = start_gdf.road_id.unique()
-    mid_ids = mid_gdf.road_id.unique()
-    end_ids = end_gdf.road_id.unique()
-    # Create a set of common buffer_ids
-    common_ids = set(start_ids) & set(mid_ids) & set(end_ids)
-
-    #now filter roads by common_ids
-    roads = roads[roads['road_id'].isin(common_ids)]
-
-    return roads
\ No newline at end of file
@@ -3,29 +3,65 @@ import requests
 import shutil
 import pandas as pd
 import geopandas as gpd
+import json
+import hashlib
 import time
 import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def download_latest_static_gtfs():
-    gtfs_url = "https://bct.tmix.se/Tmix.Cap.TdExport.WebApi/gtfs/?operatorIds=48" #Victoria, BC Transit static data
+import gtfs_tables
+from cache_utils import cache_folder, file_hash
 
-    #delete everything in static folder, but not the folder itself
-    shutil.rmtree("static")
+static_url = "https://bct.tmix.se/Tmix.Cap.TdExport.WebApi/gtfs/?operatorIds=48" #Victoria, BC Transit static data
+static_path = "static/gtfs.zip"
+
+#Refresh static/gtfs.zip only when the export has changed. The request carries the ETag/Last-Modified of the current feed,
+#so an unchanged export can be answered with a bare 304. Otherwise the body streams to a temporary file while being hashed,
+#and is only swapped in (atomically) if its sha1 differs from the current feed's. A new feed gets its version published
+#next to it (gtfs_tables.publish_version) and is converted into the GTFS cache. Downstream caches key on that version, so an
+#unchanged night leaves them all valid. Returns True if a new feed was swapped in
+def download_latest_static_gtfs(url = static_url):
     os.makedirs("static", exist_ok=True)
-    #download data and save to static folder
-    response = requests.get(gtfs_url)
-    with open("static/gtfs.zip", "wb") as f:
-        f.write(response.content)
-    
-    #unzip the file
-    import zipfile
-    with zipfile.ZipFile("static/gtfs.zip", "r") as zip_ref:
-        zip_ref.extractall("static")
-    for file in os.listdir("static"):
-        if file.endswith(".txt"):
-            #rename to csv
-            os.rename(os.path.join("static", file), os.path.join("static", file.replace(".txt", ".csv")))   
-    return
+    published = gtfs_tables.read_published(static_path)
+
+    headers = {}
+    if published.get("etag"):
+        headers["If-None-Match"] = published["etag"]
+    if published.get("last_modified"):
+        headers["If-Modified-Since"] = published["last_modified"]
+
+    part = static_path + ".part"
+    sha1 = hashlib.sha1()
+    with requests.get(url, headers=headers, stream=True, timeout=120) as response:
+        if response.status_code == 304:
+            print("Static GTFS not modified")
+            return False
+        response.raise_for_status()
+
+        with open(part, "wb") as f:
+            for block in response.iter_content(1 << 20):
+                sha1.update(block)
+                f.write(block)
+        validators = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+    sha1 = sha1.hexdigest()
+
+    current = published.get("sha1") or (file_hash(static_path) if os.path.exists(static_path) else None)
+    if sha1 == current:
+        #same feed. Keep the file (and its modification time) as it is, but remember the new validators
+        os.remove(part)
+        gtfs_tables.publish_version(static_path, sha1, **validators)
+        print("Static GTFS unchanged")
+        return False
+
+    os.replace(part, static_path)
+    version = gtfs_tables.publish_version(static_path, sha1, **validators)
+    #parse the feed once into the shared GTFS cache, which is how every module reads it
+    gtfs_tables.open_feed(static_path)
+    print(f"New static GTFS feed, version {version[:8]}")
+    return True
 
 def download_roads():
     # Base URL for the ArcGIS REST API
@@ -88,23 +124,115 @@ def download_roads():
 
         return
     
-def download_transitland_feeds():
+#Historical feed versions come from transitland. The base url can be pointed at a local stand-in for testing
+transitland_url = "https://transit.land/api/v2/rest"
+feeds_folder = "Historical Feeds"
+#partial downloads and extractions in progress. Kept out of feeds_folder, which analyze_feeds reads as a list of feeds
+transitland_folder = os.path.join(cache_folder, "transitland")
 
-    api_key = os.environ.get('TRANSITLAND_API_KEY')
+#Returns wait(), which blocks so that calls from all threads together happen at most per_second times a second
+def rate_limiter(per_second):
+    lock = threading.Lock()
+    next_time = [0.0]
 
-    headers = {
-        'Api-Key': api_key,
-    }
+    def wait():
+        with lock:
+            now = time.monotonic()
+            delay = next_time[0] - now
+            next_time[0] = max(now, next_time[0]) + 1 / per_second
+        if delay > 0:
+            time.sleep(delay)
+    return wait
 
-    #base url for the API: https://transit.land/api/v2/rest
-    base_url = "https://transit.land/api/v2/rest"
+#One session for every request, with a connection pool big enough for the workers and retries on throttling and server errors
+def transitland_session(api_key, workers):
+    session = requests.Session()
+    session.headers['Api-Key'] = api_key
+    adapter = HTTPAdapter(pool_maxsize=workers, max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
+#sha1 of the feed version extracted in a folder, if any
+def extracted_sha1(folder):
+    path = os.path.join(folder, "_transitland.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)["sha1"]
+
+#Stream a feed version's zip to disk. A partial file left by an earlier attempt is resumed with a Range request.
+#Transitland's sha1 is the hash of the zip, so the finished file is checked against it. If a resumed file doesn't match,
+#the partial file was bad and the download starts over once
+def download_feed_version(session, base_url, sha1, zip_path, wait, attempts = 3):
+    part = zip_path + ".part"
+    resumed = os.path.exists(part)
+    for attempt in range(attempts):
+        have = os.path.getsize(part) if os.path.exists(part) else 0
+        wait()
+        try:
+            #request example: GET /api/v2/rest/feed_versions/8f99f69503edfa52e06ec5673e582d3a684c05ca/download
+            with session.get(base_url + "/feed_versions/" + sha1 + "/download", headers={"Range": f"bytes={have}-"} if have else {}, stream=True, timeout=60) as response:
+                #416: nothing left to send, the partial file is already whole
+                if response.status_code != 416:
+                    response.raise_for_status()
+                    #a server that ignores the range sends the whole file again
+                    with open(part, "ab" if response.status_code == 206 else "wb") as f:
+                        for block in response.iter_content(1 << 20):
+                            f.write(block)
+            break
+        except requests.exceptions.RequestException as e:
+            if attempt == attempts - 1:
+                raise
+            print(f"Download of {sha1} interrupted ({e}), resuming")
+
+    if file_hash(part) != sha1:
+        os.remove(part)
+        if resumed:
+            print(f"Partial download of {sha1} was corrupt, starting over")
+            return download_feed_version(session, base_url, sha1, zip_path, wait, attempts)
+        raise ValueError(f"downloaded file doesn't match sha1 {sha1}")
+    os.replace(part, zip_path)
+    return
+
+#Download and extract one feed version into feeds_folder/gtfs-[year], unless that exact version is already there.
+#Extracted next to the downloads and renamed into place, so a feed folder is never half written
+def fetch_feed(session, base_url, year, sha1, wait):
+    folder = os.path.join(feeds_folder, "gtfs-" + str(year))
+    if extracted_sha1(folder) == sha1:
+        return "skipped"
+
+    zip_path = os.path.join(transitland_folder, sha1 + ".zip")
+    tmp = os.path.join(transitland_folder, sha1 + ".tmp")
+    download_feed_version(session, base_url, sha1, zip_path, wait)
+
+    shutil.rmtree(tmp, ignore_errors=True)
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        zip_ref.extractall(tmp)
+    with open(os.path.join(tmp, "_transitland.json"), "w") as f:
+        json.dump({"sha1": sha1, "year": int(year)}, f)
+
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp, folder)
+    os.remove(zip_path)
+    return "downloaded"
+
+#Download the september feed version of every year. Versions already extracted are skipped, the rest are downloaded
+#workers at a time with at most requests_per_second requests started per second. Returns {year: downloaded/skipped/failed}
+def download_transitland_feeds(base_url = transitland_url, workers = 4, requests_per_second = 1):
+
+    api_key = os.environ.get('TRANSITLAND_API_KEY')
+    session = transitland_session(api_key, workers)
+    os.makedirs(feeds_folder, exist_ok=True)
+    os.makedirs(transitland_folder, exist_ok=True)
 
     #Victoria onestop ID: 
     one_stop_id = "f-c28-bctransit~victoriaregionaltransitsystem"
 
     #search feed versions for Victoria - limit is 100
-    request = requests.get(base_url + "/feed_versions?feed_key=" + one_stop_id + "&limit=10000", headers=headers)
+    request = session.get(base_url + "/feed_versions?feed_key=" + one_stop_id + "&limit=10000", timeout=60)
+    request.raise_for_status()
 
     #create pandas dataframe from json
     df = pd.DataFrame.from_dict(request.json()['feed_versions'])
@@ -140,21 +268,20 @@ def download_transitland_feeds():
     #remove duplicate years
     df = df.drop_duplicates(subset=['Year'])
 
-    for sha1 in df['sha1']:
-        #request example: GET /api/v2/rest/feed_versions/8f99f69503edfa52e06ec5673e582d3a684c05ca/download
-        request = requests.get(base_url + "/feed_versions/" + sha1 + "/download", headers=headers)
-        #write to "Historical Feeds" with name 'gtfs-[year].zip'
-        with open("Historical Feeds/gtfs-" + str(df[df['sha1'] == sha1]['Year'].iloc[0]) + ".zip", 'wb') as f:
-            f.write(request.content)
-        
-        time.sleep(1)
+    wait = rate_limiter(requests_per_second)
 
-        #unzip file
-        with zipfile.ZipFile("Historical Feeds/gtfs-" + str(df[df['sha1'] == sha1]['Year'].iloc[0]) + ".zip", 'r') as zip_ref:
-            zip_ref.extractall("Historical Feeds/gtfs-" + str(df[df['sha1'] == sha1]['Year'].iloc[0]))
-        
-    #delete all zip files in "Historical Feeds" folder
-    for file in os.listdir("Historical Feeds"):
-        if file.endswith(".zip"):
-            os.remove("Historical Feeds/" + file)
-    return
+    def fetch(job):
+        year, sha1 = job
+        try:
+            return fetch_feed(session, base_url, year, sha1, wait)
+        except Exception as e:
+            print(f"ERROR: could not download the {year} feed ({sha1}): {e}")
+            return "failed"
+
+    jobs = list(zip(df['Year'], df['sha1']))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = dict(zip([year for year, sha1 in jobs], pool.map(fetch, jobs)))
+
+    print(f"Historical feeds: {sum(result == 'downloaded' for result in results.values())} downloaded, "
+          f"{sum(result == 'skipped' for result in results.values())} already up to date, {sum(result == 'failed' for result in results.values())} failed")
+    return results
@@ -1,25 +1,33 @@
 import datetime
+import json
+import time
+import itertools
 from urllib.request import urlopen
 import os
 import pandas as pd
 
-import pymongo
-import dns.resolver
+import lookups
 
-dns.resolver.default_resolver=dns.resolver.Resolver(configure=False)
-dns.resolver.default_resolver.nameservers=['8.8.8.8']
+#The MongoDB client is created on first use rather than at import, so importing this module (or anything that
+#imports it) doesn't need MONGO_URL, network access or pymongo
+client = None
 
-client = pymongo.MongoClient(os.environ['MONGO_URL'])
+def get_db():
+    global client
+    if client is None:
+        import pymongo
+        import dns.resolver
 
-mydb = client.Cluster0
-mycol = mydb["transit_speed_data"]
-header_col = mydb["headers"]
-trip_id_col = mydb["trip_ids"]
+        dns.resolver.default_resolver=dns.resolver.Resolver(configure=False)
+        dns.resolver.default_resolver.nameservers=['8.8.8.8']
+
+        client = pymongo.MongoClient(os.environ['MONGO_URL'])
+    return client.Cluster0
 
 def get_headers_df():
     #get all headers from mongodb and create a pandas dataframe. Return the dataframe. Columns are HeaderID and Header
     myquery = {}
-    mydoc = header_col.find(myquery)
+    mydoc = get_db()["headers"].find(myquery)
     df = pd.DataFrame(list(mydoc))
     #df = df.drop(columns=["_id"])
 
@@ -29,36 +37,130 @@ def get_headers_df():
         df = pd.concat([df, pd.DataFrame([{"Header_ID": 0, "Header": "Placeholder"}])], ignore_index=True)
     return df
 
-def download_from_mongo():
-    print("Downloading data from MongoDB")
-    #download all data from mongo
-    myquery = {}
-    mydoc = mycol.find(myquery)
-    df = pd.DataFrame(list(mydoc))
-    df = df.drop(columns=["_id"])
+timeline_folder = "historical speed data/data"
+#_id of the newest document that has been exported to disk. Each export only fetches documents newer than this
+watermark_path = "historical speed data/export_watermark.json"
+
+#Seconds behind the clock where an export stops. ObjectIds start with the second they were created, so _ids from the last
+#few minutes may still have older ones on their way from other writers
+safety_lag = 300
+
+def read_watermark():
+    #bson comes with pymongo, which is only needed once there's a database to talk to
+    from bson import ObjectId
+
+    if not os.path.exists(watermark_path):
+        return None
+    with open(watermark_path) as f:
+        return ObjectId(json.load(f)["_id"])
+
+def write_watermark(object_id):
+    with open(watermark_path + ".tmp", "w") as f:
+        json.dump({"_id": str(object_id)}, f)
+    os.replace(watermark_path + ".tmp", watermark_path)
+
+#Stream every document inserted after the watermark, and at least safety_lag ago, to a new timeline csv, batch_size documents at a time.
+#_ids follow insertion order, not 'Time', so a ping that arrives late with an old Time has a new _id and is picked up by the next export.
+#Only the newest exported _id is kept, so memory doesn't grow with the size of the export. The watermark moves once the file is on disk.
+#Returns the new watermark, or None if nothing was exported
+def download_from_mongo(collection = None, batch_size = 50000, now = None):
+    from bson import ObjectId
 
-    print("Downloaded. Saving...")
+    if collection is None:
+        collection = get_db()["transit_speed_data"]
+
+    print("Downloading data from MongoDB")
+    watermark = read_watermark()
+    cutoff = (time.time() if now is None else now) - safety_lag
+    query = {"_id": {"$lt": ObjectId.from_datetime(datetime.datetime.fromtimestamp(cutoff, datetime.timezone.utc))}}
+    if watermark is not None:
+        query["_id"]["$gt"] = watermark
+
+    cursor = collection.find(query).batch_size(batch_size)
+
+    partial_path = timeline_folder + "/export.csv.partial"
+    columns = None
+    rows = 0
+    latest_id = None
+    earliest_timestamp = None
+    latest_timestamp = None
+
+    with open(partial_path, "w", newline="") as f:
+        while True:
+            chunk = list(itertools.islice(cursor, batch_size))
+            if not chunk:
+                break
+
+            df = pd.DataFrame(chunk)
+            ids = df.pop("_id")
+            latest_id = max(ids) if latest_id is None else max(latest_id, max(ids))
+
+            #the header is written with the first chunk, so every later chunk has to fit it
+            if columns is None:
+                columns = list(df.columns)
+            extra = [column for column in df.columns if column not in columns]
+            if extra:
+                f.close()
+                os.remove(partial_path)
+                raise ValueError(f"documents after the first {rows} have fields {extra} that aren't in the csv header {columns}. Nothing was exported")
+            df = df.reindex(columns=columns)
+            df.to_csv(f, index=False, header=(rows == 0))
+
+            rows += len(df)
+            earliest_timestamp = df["Time"].min() if earliest_timestamp is None else min(earliest_timestamp, df["Time"].min())
+            latest_timestamp = df["Time"].max() if latest_timestamp is None else max(latest_timestamp, df["Time"].max())
+            print(f"{rows} documents saved...")
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    if rows == 0:
+        os.remove(partial_path)
+        print("No new data.")
+        return None
 
-    earliest_timestamp = df["Time"].min()
-    latest_timestamp = df["Time"].max()
-    
     earliest_date = datetime.datetime.fromtimestamp(earliest_timestamp).strftime('%Y-%m-%d')
     latest_date = datetime.datetime.fromtimestamp(latest_timestamp).strftime('%Y-%m-%d')
 
-    df.to_csv(f"historical speed data/data/{earliest_date}_to_{latest_date}-timeline.csv", index=False)
+    path = f"{timeline_folder}/{earliest_date}_to_{latest_date}-timeline.csv"
+    #incremental runs can cover the same dates as an earlier file
+    if os.path.exists(path):
+        path = f"{timeline_folder}/{earliest_date}_to_{latest_date}-{int(latest_timestamp)}-timeline.csv"
+    os.replace(partial_path, path)
+
+    #only after the file is in place. If this is lost, the documents are exported again rather than deleted unexported
+    write_watermark(latest_id)
     print("Saved.")
-    return
+    return latest_id
+
+#Delete only what has already been exported: every _id up to the watermark, as one range. Anything inserted since stays, however old its Time
+def clear_mongo(collection = None):
+    if collection is None:
+        collection = get_db()["transit_speed_data"]
+
+    watermark = read_watermark()
+    if watermark is None:
+        print("Nothing has been exported yet. Not clearing.")
+        return
 
-def clear_mongo():
     print("Clearing MongoDB")
-    # drop the entire collection
-    mycol.drop()
-    print("Collection dropped.")
+    result = collection.delete_many({"_id": {"$lte": watermark}})
+    print(f"{result.deleted_count} exported documents deleted.")
     return
 
-def download_and_clear():
-    download_from_mongo()
-    clear_mongo()
+#db: database handle (for example a mongomock database). Defaults to the real one
+def download_and_clear(db = None):
+    if db is None:
+        db = get_db()
+    collection = db["transit_speed_data"]
+
+    #clearing is idempotent, so an export whose clear was interrupted is cleared along with this one
+    download_from_mongo(collection)
+    clear_mongo(collection)
+
+    #bring the local lookup snapshots up to date while connected
+    for name in lookups.lookup_id_fields:
+        lookups.refresh_snapshot(name, db[name])
     return
 
 def fix():
@@ -88,6 +190,5 @@ def fix():
     return
 
 
-#download_and_clear()
-
-#download_from_mongo()
\ No newline at end of file
+if __name__ == "__main__":
+    download_and_clear()
\ No newline at end of file
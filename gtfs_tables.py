@@ -0,0 +1,213 @@
+import os
+import json
+import shutil
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import geopandas as gpd
+import shapely
+from shapely.ops import substring
+
+from cache_utils import cache_folder, cache_key, file_hash
+
+#Lean, typed reads of GTFS tables from either a zip (static/gtfs.zip) or an extracted folder (Historical Feeds/gtfs-YYYY).
+#The columns the analysis uses get explicit types. GTFS ids are text, so they're always read as strings
+#(stop_times' ids as dictionary-encoded strings, i.e. pandas categoricals, since each one repeats on many rows).
+#Times (HH:MM:SS, hours can be 24 or more for service past midnight) become integer seconds after midnight
+#
+#Every module gets at a feed through its version: the content hash of the zip, or of the folder's .txt files. The first time a
+#version is opened, its tables are converted once into cache/gtfs/<version>/ as parquet, along with the assembled shapes and
+#route lines. Later loads are memory-mapped parquet reads of only the columns asked for.
+#A new version of the same source (a fresh static/gtfs.zip) replaces the old one
+gtfs_cache_folder = os.path.join(cache_folder, "gtfs")
+column_types = {
+    "trip_id": pa.string(), "route_id": pa.string(), "service_id": pa.string(), "shape_id": pa.string(), "stop_id": pa.string(),
+    "arrival_time": pa.string(), "departure_time": pa.string(), "stop_sequence": pa.int32(),
+    "shape_pt_lat": pa.float64(), "shape_pt_lon": pa.float64(), "shape_pt_sequence": pa.int32(),
+    "stop_lat": pa.float64(), "stop_lon": pa.float64()
+}
+stop_times_types = dict(column_types, trip_id=pa.dictionary(pa.int32(), pa.string()), stop_id=pa.dictionary(pa.int32(), pa.string()))
+time_columns = ["arrival_time", "departure_time"]
+
+#HH:MM:SS (or H:MM:SS) strings to seconds after midnight, in one vectorized pass. Empty times (non-timepoints) stay null
+def time_seconds(times):
+    times = pc.utf8_trim_whitespace(times)
+    #minutes and seconds are always two digits, so the hours are whatever comes before the last six characters
+    hours = pc.cast(pc.utf8_slice_codeunits(times, 0, -6), pa.int32())
+    minutes = pc.cast(pc.utf8_slice_codeunits(times, -5, -3), pa.int32())
+    seconds = pc.cast(pc.utf8_slice_codeunits(times, -2), pa.int32())
+    return pc.cast(pc.add(pc.add(pc.multiply(hours, 3600), pc.multiply(minutes, 60)), seconds), pa.int32())
+
+#columns of a GTFS table as an arrow table (all columns if None)
+def read_arrow(source, name, columns = None, types = column_types):
+    options = pv.ConvertOptions(include_columns=columns or [], column_types=types, strings_can_be_null=True)
+    if source.endswith(".zip"):
+        with zipfile.ZipFile(source) as archive, archive.open(name + ".txt") as f:
+            table = pv.read_csv(f, convert_options=options)
+    else:
+        table = pv.read_csv(os.path.join(source, name + ".txt"), convert_options=options)
+
+    for column in time_columns:
+        if column in table.column_names:
+            table = table.set_column(table.column_names.index(column), column, time_seconds(table[column]))
+    return table
+
+#take shapes.txt df, add segments together, and compute length in meters
+def aggregate_shapes(shapes):
+    #one pass: sort points by shape and sequence, then build every line at once from the sorted coordinates.
+    #indices tells shapely which line each point belongs to. Shapes with a single point can't form a line and are dropped
+    shapes = shapes.sort_values(by=['shape_id', 'shape_pt_sequence'], kind='stable')
+    shapes = shapes[shapes.groupby('shape_id').shape_id.transform('size') > 1]
+
+    codes, shape_ids = pd.factorize(shapes['shape_id'], sort=True)
+    coordinates = shapes[['shape_pt_lon', 'shape_pt_lat']].to_numpy(dtype=np.float64)
+    geometry = shapely.linestrings(coordinates, indices=codes)
+
+    lines = gpd.GeoDataFrame({'shape_id': np.asarray(shape_ids)}, geometry=geometry, crs="EPSG:4326")
+    lines['length'] = lines.geometry.to_crs(epsg=26910).length.to_numpy()
+    return lines
+
+#Every shape that has trips, from its first stop to its last, in EPSG:26910: the ground the stop-to-stop segments cover
+def build_route_lines(trips, stop_times, stops, shapes):
+    shapes = shapes.to_crs("EPSG:26910")
+
+    #the stops each shape serves. trip_id is categorical, so mapping it only touches each trip once
+    stop_times = stop_times[['trip_id', 'stop_id']].copy()
+    stop_times['shape_id'] = stop_times.trip_id.map(trips.set_index('trip_id').shape_id)
+    served = stop_times[['shape_id', 'stop_id']].drop_duplicates().astype(str)
+    served = served.merge(stops, on='stop_id').merge(pd.DataFrame({'shape_id': shapes.shape_id, 'line': np.arange(len(shapes))}), on='shape_id')
+
+    #how far along its shape each stop is, then the stretch between the first and last
+    points = gpd.GeoSeries(gpd.points_from_xy(served.stop_lon, served.stop_lat), crs="EPSG:4326").to_crs("EPSG:26910")
+    lines = shapes.geometry.to_numpy()
+    served['position'] = shapely.line_locate_point(lines[served.line.to_numpy()], points.to_numpy())
+    extent = served.groupby('line').position.agg(['min', 'max'])
+
+    geometry = [substring(lines[line], start, end) for line, start, end in zip(extent.index, extent['min'], extent['max'])]
+    return gpd.GeoDataFrame({'shape_id': shapes.shape_id.to_numpy()[extent.index]}, geometry=geometry, crs="EPSG:26910")
+
+#Names of the tables in a feed
+def source_tables(source):
+    if source.endswith(".zip"):
+        with zipfile.ZipFile(source) as archive:
+            names = archive.namelist()
+    else:
+        names = os.listdir(source)
+    return sorted(name[:-len(".txt")] for name in names if name.endswith(".txt"))
+
+#(path, size, mtime): version. Hashing a feed reads all of it, so it's done once per process for each unchanged file
+versions = {}
+
+def files_version(named_hashes):
+    return cache_key("gtfs v1", named_hashes)
+
+#A zip's version can be published next to it (<zip>.version.json) by whatever downloads it, along with the sha1 it came from
+#and the server's validators. It stays valid as long as the zip's size and modification time match
+def published_path(source):
+    return source + ".version.json"
+
+def publish_version(source, sha1, **validators):
+    record = dict(validators, version=files_version([[os.path.basename(source), sha1]]), sha1=sha1,
+                  size=os.path.getsize(source), mtime=os.path.getmtime(source))
+    with open(published_path(source) + ".tmp", "w") as f:
+        json.dump(record, f, indent=1, sort_keys=True)
+    os.replace(published_path(source) + ".tmp", published_path(source))
+    return record["version"]
+
+#The published record for a zip, or {} if there's none or the zip has changed since
+def read_published(source):
+    if not os.path.exists(published_path(source)) or not os.path.exists(source):
+        return {}
+    with open(published_path(source)) as f:
+        record = json.load(f)
+    if record["size"] != os.path.getsize(source) or record["mtime"] != os.path.getmtime(source):
+        return {}
+    return record
+
+def feed_version(source):
+    if source.endswith(".zip"):
+        published = read_published(source)
+        if published:
+            return published["version"]
+        paths = [source]
+    else:
+        paths = [os.path.join(source, name + ".txt") for name in source_tables(source)]
+
+    stamp = tuple((path, os.path.getsize(path), os.path.getmtime(path)) for path in paths)
+    if stamp not in versions:
+        versions[stamp] = files_version([[os.path.basename(path), file_hash(path)] for path in paths])
+    return versions[stamp]
+
+def version_folder(version):
+    return os.path.join(gtfs_cache_folder, version)
+
+def read_feed_info(version):
+    with open(os.path.join(version_folder(version), "_feed.json")) as f:
+        return json.load(f)
+
+#Convert every table of a feed, plus shapes and route lines, into a new version folder. Written to a temporary folder and
+#renamed into place, so a half-converted feed is never opened
+def convert_feed(source, version):
+    print(f"Converting GTFS feed {source} ({version[:8]})")
+    folder = version_folder(version)
+    tmp = folder + f".{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    tables = source_tables(source)
+    for name in tables:
+        types = stop_times_types if name == "stop_times" else column_types
+        pq.write_table(read_arrow(source, name, types=types), os.path.join(tmp, name + ".parquet"))
+
+    if "shapes" in tables:
+        shapes = aggregate_shapes(pq.read_table(os.path.join(tmp, "shapes.parquet")).to_pandas())
+        shapes.to_parquet(os.path.join(tmp, "shapes-lines.parquet"), index=False)
+        if all(name in tables for name in ["trips", "stop_times", "stops"]):
+            route_lines = build_route_lines(
+                pq.read_table(os.path.join(tmp, "trips.parquet"), columns=["trip_id", "shape_id"]).to_pandas(),
+                pq.read_table(os.path.join(tmp, "stop_times.parquet"), columns=["trip_id", "stop_id"]).to_pandas(),
+                pq.read_table(os.path.join(tmp, "stops.parquet"), columns=["stop_id", "stop_lat", "stop_lon"]).to_pandas(),
+                shapes)
+            route_lines.to_parquet(os.path.join(tmp, "route-lines.parquet"), index=False)
+
+    with open(os.path.join(tmp, "_feed.json"), "w") as f:
+        json.dump({"source": os.path.abspath(source), "tables": tables}, f, indent=1)
+
+    try:
+        os.rename(tmp, folder)
+    except OSError:
+        #another process converted the same version first
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+
+    #older versions of the same source are superseded
+    for other in os.listdir(gtfs_cache_folder):
+        if other == version or other.endswith(".tmp") or not os.path.exists(os.path.join(version_folder(other), "_feed.json")):
+            continue
+        if read_feed_info(other)["source"] == os.path.abspath(source):
+            shutil.rmtree(version_folder(other), ignore_errors=True)
+    return
+
+#Version of a feed, converting it into the cache the first time it's seen
+def open_feed(source):
+    version = feed_version(source)
+    if not os.path.exists(version_folder(version)):
+        convert_feed(source, version)
+    return version
+
+#Columns of a table of a converted feed (all if None). Memory-mapped, and only the columns asked for are read
+def load_table(version, name, columns = None):
+    return pq.read_table(os.path.join(version_folder(version), name + ".parquet"), columns=columns, memory_map=True).to_pandas()
+
+#shapes.txt assembled into lines, with lengths in meters (aggregate_shapes)
+def load_shapes(version):
+    return gpd.read_parquet(os.path.join(version_folder(version), "shapes-lines.parquet"), memory_map=True)
+
+#build_route_lines for the feed
+def load_route_lines(version):
+    return gpd.read_parquet(os.path.join(version_folder(version), "route-lines.parquet"), memory_map=True)
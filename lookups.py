@@ -0,0 +1,120 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+#Local snapshots of the small dictionary collections in MongoDB (header text), so analysis can run offline
+#and doesn't download them on every call. Each snapshot refreshes incrementally: only documents with an id above the
+#highest one already saved are fetched. Snapshots are loaded once per process and shared by every caller.
+lookup_folder = "historical speed data/lookups"
+versions_path = lookup_folder + "/_versions.json"
+
+#collection name: integer id field. Only collections something actually looks up belong here, since download_and_clear
+#refreshes every one of them each night
+lookup_id_fields = {"headers": "Header_ID"}
+
+snapshots = {}
+lookup_tables = {}
+refreshed = set()
+
+def snapshot_path(name):
+    return lookup_folder + "/" + name + ".parquet"
+
+def read_versions():
+    if not os.path.exists(versions_path):
+        return {}
+    with open(versions_path) as f:
+        return json.load(f)
+
+def snapshot_version(name):
+    return read_versions().get(name, 0)
+
+def save_snapshot(name, df):
+    os.makedirs(lookup_folder, exist_ok=True)
+    df.to_parquet(snapshot_path(name) + ".tmp", index=False)
+    os.replace(snapshot_path(name) + ".tmp", snapshot_path(name))
+
+    versions = read_versions()
+    versions[name] = versions.get(name, 0) + 1
+    with open(versions_path + ".tmp", "w") as f:
+        json.dump(versions, f, indent=1, sort_keys=True)
+    os.replace(versions_path + ".tmp", versions_path)
+    return
+
+#Fetch documents newer than the snapshot from MongoDB and save a new version if there were any
+def refresh_snapshot(name, collection = None):
+    if collection is None:
+        #only needs the database when actually refreshing
+        import download_from_mongodb
+        collection = download_from_mongodb.get_db()[name]
+
+    id_field = lookup_id_fields[name]
+    df = load_snapshot(name)
+
+    query = {}
+    if not df.empty:
+        query = {id_field: {"$gt": int(df[id_field].max())}}
+    new = pd.DataFrame(list(collection.find(query, {"_id": 0})))
+
+    if not new.empty:
+        df = pd.concat([df, new], ignore_index=True).drop_duplicates(subset=id_field, keep="last")
+        df = df.sort_values(by=id_field).reset_index(drop=True)
+        save_snapshot(name, df)
+        print(f"{name}: {len(new)} new entries, snapshot version {snapshot_version(name)}")
+
+    snapshots[name] = df
+    for key in [key for key in lookup_tables if key[0] == name]:
+        del lookup_tables[key]
+    refreshed.add(name)
+    return df
+
+def load_snapshot(name):
+    if name in snapshots:
+        return snapshots[name]
+    if os.path.exists(snapshot_path(name)):
+        snapshots[name] = pd.read_parquet(snapshot_path(name))
+        return snapshots[name]
+    return pd.DataFrame(columns=[lookup_id_fields[name]])
+
+#The process-wide snapshot. Downloads it the first time if there's nothing on disk
+def get_snapshot(name):
+    df = load_snapshot(name)
+    if df.empty and name not in refreshed:
+        try:
+            df = refresh_snapshot(name)
+        except Exception as e:
+            raise RuntimeError(f"No local {name} snapshot and it can't be downloaded ({e!r}). "
+                               "Run download_from_mongodb.download_and_clear once with MONGO_URL set.") from e
+    return df
+
+#Array where position i holds value_field for id i (None where there's no entry), so lookups are plain indexing instead of a merge
+def lookup_table(name, value_field):
+    if (name, value_field) not in lookup_tables:
+        df = get_snapshot(name)
+        ids = df[lookup_id_fields[name]].to_numpy().astype(np.int64)
+        table = np.full(ids.max() + 1 if len(ids) else 0, None, dtype=object)
+        table[ids] = df[value_field].to_numpy()
+        lookup_tables[(name, value_field)] = table
+    return lookup_tables[(name, value_field)]
+
+#value_field for each id. Ids newer than the snapshot trigger one incremental refresh per process (skipped when offline)
+def lookup(name, value_field, ids):
+    ids = np.asarray(ids, dtype=np.int64)
+    table = lookup_table(name, value_field)
+
+    if name not in refreshed and len(ids) and ids.max() >= len(table):
+        try:
+            refresh_snapshot(name)
+            table = lookup_table(name, value_field)
+        except Exception as e:
+            print(f"Could not refresh {name} ({e}). Using the local snapshot.")
+            refreshed.add(name)
+
+    values = np.full(len(ids), None, dtype=object)
+    found = (ids >= 0) & (ids < len(table))
+    values[found] = table[ids[found]]
+    return values
+
+def header_names(header_ids):
+    return lookup("headers", "Header", header_ids)
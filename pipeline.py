@@ -0,0 +1,329 @@
+import os
+import re
+import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import analysis
+import lookups
+import gtfs_tables
+import timeline_store
+import speed_cube
+import speed_partials
+import runtime_sketches
+import render_pool
+from cache_utils import cache_folder, cache_key, file_hash
+from create_shapes import gtfs_path, roads_path
+
+#Incremental replacement for the old hand-edited run_all(). Every stage gets a fingerprint built from its raw inputs, its
+#parameters, its code and the fingerprints of the stages it depends on. A stage whose fingerprint matches its last successful
+#run, and whose outputs are all still there, is skipped. Stages that don't depend on each other run at the same time in a
+#thread pool (per-route rendering inside a stage still goes through render_pool's worker processes).
+#
+#Each stage is a dict:
+#  deps: stages whose values are passed to run, in order
+#  after: stages that have to finish first if they're running, but whose values aren't used (and don't count towards the fingerprint)
+#  inputs: function returning whatever identifies the stage's raw inputs (file stamps, lookup versions)
+#  code: modules the stage's results depend on. Editing one reruns the stage
+#  params: keyword arguments for run and load
+#  run: builds the stage's outputs and returns its value (what dependent stages receive)
+#  load: optional. Rebuilds the value from the saved outputs, so dependents of an up-to-date stage don't have to rerun it
+#  outputs: files or folders the stage writes. A missing output reruns the stage
+#  workers: optional. True if run starts worker processes (render_pool). It's then passed workers=, its share of the
+#           pipeline's process budget, so stages running at the same time don't each start a pool the size of the machine
+state_path = os.path.join(cache_folder, "pipeline_state.json")
+
+plots_folder = "docs/plots"
+#stage code is hashed from where these modules live, whatever the working directory
+code_folder = os.path.dirname(os.path.abspath(__file__))
+
+#Name, size and modification time. Enough to notice a new or re-downloaded file without reading it. None if the file is missing
+def file_stamp(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, int(stat.st_mtime)]
+
+def csv_files():
+    if not os.path.exists(timeline_store.csv_folder):
+        return []
+    return sorted(filename for filename in os.listdir(timeline_store.csv_folder) if filename.endswith(".csv"))
+
+def csv_stamps(filenames):
+    return [file_stamp(os.path.join(timeline_store.csv_folder, filename)) for filename in filenames] + [timeline_store.schema_version]
+
+#The csv files that can contribute pings to retrieve_timeline(file_limit): the file_limit most recent ones (as in
+#timeline_store.recent_start_date) and any older file whose dates reach into that window. A new file only changes the windows it falls in
+def window_files(file_limit):
+    files = csv_files()
+    dates = {filename: re.findall(r"\d{4}-\d{2}-\d{2}", filename) for filename in files}
+    dated = sorted([filename for filename in files if len(dates[filename]) >= 2], key=lambda filename: dates[filename][0], reverse=True)
+    if not dated:
+        return files
+
+    start = min(dates[filename][0] for filename in dated[:file_limit])
+    return [filename for filename in files if len(dates[filename]) < 2 or dates[filename][1] >= start]
+
+#The static feed's published version (its content hash), so a re-download of the same feed doesn't rerun anything
+def gtfs_version():
+    if not os.path.exists(gtfs_path):
+        return None
+    return gtfs_tables.feed_version(gtfs_path)
+
+def plot_paths(*names):
+    return [os.path.join(plots_folder, name) for name in names]
+
+def config_stamps(*names):
+    return [file_stamp(os.path.join("kepler_configs", name)) for name in names]
+
+def stages():
+    return {
+        "ingest": {
+            "inputs": lambda: csv_stamps(csv_files()),
+            "code": ["timeline_store.py"],
+            "run": lambda: timeline_store.convert_csv_to_parquet(),
+            "outputs": [timeline_store.manifest_path]
+        },
+        "timeline": {
+            "after": ["ingest"],
+            "inputs": lambda: csv_stamps(window_files(3)),
+            "params": {"file_limit": 3},
+            "run": lambda file_limit: analysis.retrieve_timeline(file_limit, geometry=False)
+        },
+        "partials": {
+            "after": ["ingest"],
+            "inputs": lambda: csv_stamps(csv_files()) + [gtfs_version(), file_stamp(roads_path), file_stamp("roads/corridors.geojson"), file_stamp("roads/corridor_routes.json")],
+            "code": ["speed_partials.py", "segment_assignment.py", "create_shapes.py", "gtfs_tables.py"],
+            "workers": True,
+            "run": lambda workers: analysis.update_speed_partials(workers),
+            "outputs": [speed_partials.partials_folder]
+        },
+        "aggregates": {
+            "deps": ["partials"],
+            "inputs": lambda: csv_stamps(window_files(3)),
+            "code": ["speed_cube.py"],
+            "params": {"file_limit": 3},
+            "run": lambda partials, file_limit: analysis.segment_speed_cube(file_limit, update=False),
+            #the cube for the current window. It's the one the stage saved: the window only moves with the csv files in the fingerprint
+            "load": lambda file_limit: speed_cube.load_speed_cube(*analysis.date_window(file_limit)),
+            "outputs": [speed_cube.cube_path(*analysis.date_window(3))]
+        },
+        "system_maps": {
+            "deps": ["aggregates"],
+            "inputs": lambda: config_stamps("speed_map.json", "delta_map.json"),
+            "code": ["analysis.py"],
+            "run": lambda cube: analysis.system_map(cube=cube),
+            "outputs": plot_paths("system_speed_map.html", "system_speed_peak_map.html", "system_delta_map.html")
+        },
+        "dot_map": {
+            "deps": ["timeline"],
+            "inputs": lambda: config_stamps("dot_map.json"),
+            "code": ["analysis.py"],
+            "run": lambda timeline: analysis.dot_map(timeline),
+            "outputs": plot_paths("dot_map.html")
+        },
+        "corridor_map": {
+            "deps": ["partials"],
+            "inputs": lambda: csv_stamps(window_files(3)) + config_stamps("corridor_map.json"),
+            "code": ["analysis.py"],
+            "params": {"file_limit": 3},
+            "run": lambda partials, file_limit: analysis.corridor_map(file_limit, update=False),
+            "outputs": plot_paths("corridor_map.html")
+        },
+        "all_routes_bar_chart": {
+            "deps": ["partials"],
+            "inputs": lambda: csv_stamps(window_files(3)),
+            "code": ["analysis.py"],
+            "params": {"file_limit": 3},
+            "run": lambda partials, file_limit: analysis.all_routes_bar_chart(file_limit, update=False),
+            "outputs": plot_paths("all_routes_bar_chart.html")
+        },
+        "runtimes_by_time": {
+            "after": ["ingest"],
+            "inputs": lambda: csv_stamps(window_files(3)) + [lookups.read_versions()],
+            "code": ["analysis.py", "smoothing.py"],
+            "params": {"file_limit": 3},
+            "workers": True,
+            "run": lambda file_limit, workers: analysis.runtimes_by_time(file_limit=file_limit, workers=workers),
+            "outputs": plot_paths("runtime_by_time")
+        },
+        "runtime_sketches": {
+            "after": ["ingest"],
+            "inputs": lambda: csv_stamps(csv_files()),
+            "code": ["runtime_sketches.py", "analysis.py"],
+            "workers": True,
+            "run": lambda workers: analysis.update_runtime_sketches(workers),
+            "outputs": [runtime_sketches.sketch_folder]
+        },
+        "runtimes_by_date": {
+            "deps": ["runtime_sketches"],
+            "inputs": lambda: csv_stamps(window_files(100)),
+            "code": ["analysis.py"],
+            "params": {"file_limit": 100},
+            "workers": True,
+            "run": lambda sketches, file_limit, workers: analysis.runtimes_by_date(file_limit, workers=workers, update=False),
+            "outputs": plot_paths("runtime_by_date")
+        }
+    }
+
+def read_state():
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+def write_state(state):
+    os.makedirs(cache_folder, exist_ok=True)
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(state_path + ".tmp", state_path)
+
+def fingerprint(name, stage, fingerprints):
+    inputs = stage["inputs"]() if "inputs" in stage else None
+    code = [file_hash(os.path.join(code_folder, path)) for path in stage.get("code", [])]
+    return cache_key(name, stage.get("params", {}), [fingerprints[dep] for dep in stage.get("deps", [])], inputs, code)
+
+#targets and everything they depend on, in the order the stages are defined (dependencies always come first)
+def select_stages(all_stages, targets = None):
+    if targets is None:
+        return list(all_stages)
+
+    selected = set()
+    def add(name):
+        if name not in all_stages:
+            raise ValueError(f"Unknown stage '{name}'. Stages: {', '.join(all_stages)}")
+        if name in selected:
+            return
+        selected.add(name)
+        for dep in all_stages[name].get("deps", []) + all_stages[name].get("after", []):
+            add(dep)
+    for name in targets:
+        add(name)
+
+    return [name for name in all_stages if name in selected]
+
+#What each stage has to do: "run" it, "load" its value from its outputs, or nothing (left out). Stale stages run.
+#Their dependencies load if they're up to date and can, and otherwise run too
+def plan(all_stages, order, stale):
+    actions = {}
+
+    def require(name, value_only):
+        if actions.get(name) == "run":
+            return
+        if value_only and name not in stale and "load" in all_stages[name]:
+            actions[name] = "load"
+            return
+        actions[name] = "run"
+        for dep in all_stages[name].get("deps", []):
+            require(dep, True)
+
+    for name in order:
+        if name in stale:
+            require(name, False)
+    return actions
+
+#Bring the selected stages (default: all of them) up to date. force=True reruns them regardless of their fingerprints.
+#workers is the number of worker processes shared by all the stages (default: render_pool.default_workers()).
+#Returns the names of stages that failed
+def run(targets = None, force = False, workers = None):
+    budget = workers or render_pool.default_workers()
+    all_stages = stages()
+    order = select_stages(all_stages, targets)
+
+    fingerprints = {}
+    for name in order:
+        fingerprints[name] = fingerprint(name, all_stages[name], fingerprints)
+
+    state = read_state()
+    stale = set()
+    for name in order:
+        outputs = all_stages[name].get("outputs", [])
+        if force or state.get(name) != fingerprints[name] or not all(os.path.exists(path) for path in outputs):
+            stale.add(name)
+
+    actions = plan(all_stages, order, stale)
+    for name in order:
+        if name not in actions:
+            print(f"{name}: up to date")
+    if not actions:
+        return []
+
+    pending = [name for name in order if name in actions]
+    #how many planned stages still need each value, so large values (timelines) are released as soon as nothing else needs them
+    users = {name: sum(name in all_stages[other].get("deps", []) and actions[other] == "run" for other in pending) for name in pending}
+    values = {}
+    failed = []
+    running = {}
+    started = {}
+    #worker processes handed to each running stage
+    allocated = {}
+
+    with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+        while pending or running:
+            ready = []
+            for name in list(pending):
+                stage = all_stages[name]
+                deps = stage.get("deps", [])
+
+                #dependents of a failed stage can't run
+                if actions[name] == "run" and any(dep in failed for dep in deps):
+                    print(f"{name}: skipped, a stage it depends on failed")
+                    pending.remove(name)
+                    failed.append(name)
+                    continue
+
+                if any(other in pending or other in running.values() for other in stage.get("after", [])):
+                    continue
+                if actions[name] == "load" or all(dep in values for dep in deps):
+                    ready.append(name)
+
+            #the processes not held by running stages are split evenly between the stages starting now that use them
+            pooled = [name for name in ready if actions[name] == "run" and all_stages[name].get("workers")]
+            free = budget - sum(allocated.values())
+            for name in ready:
+                stage = all_stages[name]
+                if actions[name] == "load":
+                    future = pool.submit(stage["load"], **stage.get("params", {}))
+                elif name in pooled:
+                    #the first free % len(pooled) stages take one of the leftover processes each
+                    allocated[name] = max(1, free // len(pooled) + (pooled.index(name) < free % len(pooled)))
+                    future = pool.submit(stage["run"], *[values[dep] for dep in stage.get("deps", [])], workers=allocated[name], **stage.get("params", {}))
+                else:
+                    future = pool.submit(stage["run"], *[values[dep] for dep in stage.get("deps", [])], **stage.get("params", {}))
+
+                pending.remove(name)
+                running[future] = name
+                started[name] = time.time()
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                allocated.pop(name, None)
+                try:
+                    values[name] = future.result()
+                except Exception as e:
+                    print(f"ERROR: stage {name} failed: {e}")
+                    failed.append(name)
+                    continue
+
+                if actions[name] == "run":
+                    state[name] = fingerprints[name]
+                    write_state(state)
+                print(f"{name}: {'ran' if actions[name] == 'run' else 'loaded'} in {time.time() - started[name]:.1f}s")
+
+                for dep in all_stages[name].get("deps", []):
+                    if actions[name] == "run" and dep in users:
+                        users[dep] -= 1
+                        if users[dep] == 0:
+                            values.pop(dep, None)
+
+    return failed
+
+#python pipeline.py [stage ...] [--force]
+if __name__ == "__main__":
+    arguments = [argument for argument in sys.argv[1:] if argument != "--force"]
+    run(arguments or None, force="--force" in sys.argv[1:])
@@ -0,0 +1,45 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+#Per-route figures are independent and CPU-bound, so they're rendered in a pool of worker processes.
+#Each job only carries its own route's rows. Data every job needs is sent once per worker (through the pool initializer)
+#and read from render_pool.shared, rather than being pickled into every task.
+#The same pool builds the per-file speed partials and per-date runtime sketches, one partition per job.
+
+shared = None
+#In-process runs set shared in this process, so pipeline stages running in other threads take turns
+shared_lock = threading.RLock()
+
+def set_shared(data):
+    global shared
+    shared = data
+
+#Worker count: RENDER_WORKERS environment variable if set, otherwise one per core
+def default_workers():
+    return int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1))
+
+#Call function(job) for every job and return the results, in order. With workers=1 (or a single job) everything runs in this process.
+#Also used for partition-parallel processing: each job is one file or date partition, so a worker only ever holds one partition
+def map_all(function, jobs, shared_data = None, workers = None):
+    if workers is None:
+        workers = default_workers()
+    jobs = list(jobs)
+
+    if workers <= 1 or len(jobs) <= 1:
+        with shared_lock:
+            set_shared(shared_data)
+            return [function(job) for job in jobs]
+
+    #forking while other threads are running (the pipeline runs several stages at once) can deadlock the workers, so spawn them then
+    context = multiprocessing.get_context("spawn") if threading.active_count() > 1 else None
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=context, initializer=set_shared, initargs=(shared_data,)) as pool:
+        #errors in workers are raised here
+        return list(pool.map(function, jobs))
+
+#Call render(job) for every job, in parallel
+def render_all(render, jobs, shared_data = None, workers = None):
+    map_all(render, jobs, shared_data, workers)
+    return
@@ -0,0 +1,158 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from cache_utils import cache_folder, cache_key
+import timeline_store
+import render_pool
+
+#Mergeable runtime sketches for the runtime by date plots. For every service date in the store, trip runtimes are kept as a
+#sparse histogram: trip counts by service_date, Route, Header and runtime bin. Histograms simply add up, so percentiles for any
+#date range (grouped by any of date, route and header) come from summed bins, without reloading pings or holding every trip.
+#
+#Error bound: runtimes are whole seconds (the difference of two epoch timestamps). Each bin covers bin_seconds of them and stands
+#for its middle value. Binning is monotone, so every order statistic moves by at most (bin_seconds - 1) / 2 seconds, and so does
+#any percentile interpolated between two of them (the same linear rule as np.percentile). With bin_seconds = 1 the percentiles are
+#exact. A histogram has at most (200 - 5) * 60 / bin_seconds bins per key, however many trips it counts.
+#
+#Dates, rather than source files, are the unit because the first and last day of consecutive files overlap, and a trip split
+#across two files has to be summarised in one piece. A date is rebuilt when any source file covering it changes.
+#A fixed tenth of the trips (picked by a hash of the trip-in-time id, so the same trips every time) is kept per date for the scatter.
+#Files: cache/runtime_sketches/<service_date>.parquet and <service_date>-sample.parquet. _dates.json records the key each date was built with
+sketch_folder = os.path.join(cache_folder, "runtime_sketches")
+dates_path = os.path.join(sketch_folder, "_dates.json")
+
+bin_seconds = 1
+sample_fraction = 10
+
+sketch_columns = ["Time", "Route", "Header", "Trip ID", "Speed", "service_date", "weekday"]
+
+def histogram_path(service_date):
+    return os.path.join(sketch_folder, str(service_date) + ".parquet")
+
+def sample_path(service_date):
+    return os.path.join(sketch_folder, str(service_date) + "-sample.parquet")
+
+def read_dates():
+    if not os.path.exists(dates_path):
+        return {}
+    with open(dates_path) as f:
+        return json.load(f)
+
+def write_dates(dates):
+    os.makedirs(sketch_folder, exist_ok=True)
+    with open(dates_path + ".tmp", "w") as f:
+        json.dump(dates, f, indent=1, sort_keys=True)
+    os.replace(dates_path + ".tmp", dates_path)
+
+#Every YYYYMMDD date from start to end, inclusive
+def dates_between(start, end):
+    dates = pd.date_range(pd.Timestamp(str(start)), pd.Timestamp(str(end)))
+    return list(dates.year * 10000 + dates.month * 100 + dates.day)
+
+#Histogram and sample of one date's trips (summarize_trip_data output, with header ids)
+def build_sketch(trips):
+    service_date = trips.custom_id.to_numpy() >> 32
+    runtime_bin = (trips.Time_max.to_numpy() - trips.Time_min.to_numpy()) // bin_seconds
+
+    histogram = pd.DataFrame({
+        "service_date": service_date.astype(np.int32),
+        "Route": trips.Route.to_numpy(),
+        "Header": trips.Header.to_numpy().astype(np.int64),
+        "bin": runtime_bin.astype(np.int32)
+    }).groupby(["service_date", "Route", "Header", "bin"], sort=True).size().rename("count").reset_index()
+
+    in_sample = pd.util.hash_array(trips.custom_id.to_numpy().astype(np.uint64)) % sample_fraction == 0
+    sample = trips.loc[in_sample, ["custom_id", "Route", "Time_min", "runtime"]].reset_index(drop=True)
+
+    return histogram, sample
+
+#Sketch of one service date, built in a worker process from that date's partition only. summarize comes from render_pool.shared.
+#Returns the date, or None if the partition has no pings
+def build_date_sketch(service_date):
+    summarize = render_pool.shared
+    pings = timeline_store.read_timeline(service_date, service_date, columns=sketch_columns)
+    if pings.empty:
+        return None
+    histogram, sample = build_sketch(summarize(pings))
+
+    histogram.to_parquet(histogram_path(service_date), index=False)
+    sample.to_parquet(sample_path(service_date), index=False)
+    return service_date
+
+#Build sketches for every service date that doesn't have up-to-date ones, one date per job across a pool of workers.
+#summarize(pings) turns a date's pings into trips and has to be picklable (a module-level function or functools.partial).
+#Sketches of dates no longer in the store are removed
+def update_sketches(summarize, workers = None):
+    os.makedirs(sketch_folder, exist_ok=True)
+    manifest = timeline_store.read_manifest()
+
+    #the source files covering each date
+    covering = {}
+    for filename, entry in sorted(manifest.items()):
+        for service_date in dates_between(entry["start"], entry["end"]):
+            covering.setdefault(service_date, []).append([filename, entry])
+
+    built = read_dates()
+    keys = {service_date: cache_key(entries, bin_seconds, sample_fraction) for service_date, entries in covering.items()}
+    stale = [service_date for service_date in sorted(covering) if built.get(str(service_date)) != keys[service_date] or not os.path.exists(histogram_path(service_date))]
+
+    for service_date in render_pool.map_all(build_date_sketch, stale, shared_data=summarize, workers=workers):
+        if service_date is not None:
+            built[str(service_date)] = keys[service_date]
+
+    for service_date in [service_date for service_date in built if int(service_date) not in covering]:
+        for path in [histogram_path(service_date), sample_path(service_date)]:
+            if os.path.exists(path):
+                os.remove(path)
+        del built[service_date]
+    write_dates(built)
+    return
+
+def window_dates(start_date = None, end_date = None):
+    return [int(service_date) for service_date in sorted(read_dates())
+            if (start_date is None or int(service_date) >= start_date) and (end_date is None or int(service_date) <= end_date)]
+
+def read_histograms(start_date = None, end_date = None):
+    frames = [pd.read_parquet(histogram_path(service_date)) for service_date in window_dates(start_date, end_date)]
+    if not frames:
+        return pd.DataFrame({"service_date": [], "Route": [], "Header": [], "bin": [], "count": []})
+    return pd.concat(frames, ignore_index=True)
+
+#The sampled trips over the window
+def read_samples(start_date = None, end_date = None):
+    frames = [pd.read_parquet(sample_path(service_date)) for service_date in window_dates(start_date, end_date)]
+    if not frames:
+        return pd.DataFrame({"custom_id": [], "Route": [], "Time_min": [], "runtime": []})
+    return pd.concat(frames, ignore_index=True)
+
+#Runtime percentiles (minutes) for each group of by (any of service_date, Route, Header) over a service date window.
+#percentiles are 0-100. Returns the by columns, the trip count and one column per percentile
+def runtime_percentiles(percentiles, start_date = None, end_date = None, by = ("service_date", "Route")):
+    by = list(by)
+    histogram = read_histograms(start_date, end_date)
+    histogram = histogram.groupby(by + ["bin"], sort=True)["count"].sum().reset_index()
+
+    values = (histogram["bin"].to_numpy() * bin_seconds + (bin_seconds - 1) / 2) / 60
+    counts = histogram["count"].to_numpy()
+    cumulative = np.cumsum(counts)
+
+    #rows are sorted by group, so each group's bins are contiguous and its ranks start at the total count of the groups before it
+    codes = histogram.groupby(by, sort=False).ngroup().to_numpy()
+    n = np.bincount(codes, weights=counts).astype(np.int64)
+    offset = np.cumsum(n) - n
+
+    result = histogram[by].drop_duplicates().reset_index(drop=True)
+    result['trips'] = n
+    for q in percentiles:
+        #position between order statistics, as in np.percentile
+        position = (n - 1) * q / 100
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, n - 1)
+        lower_value = values[np.searchsorted(cumulative, offset + lower, side="right")]
+        upper_value = values[np.searchsorted(cumulative, offset + upper, side="right")]
+        result[q] = lower_value + (upper_value - lower_value) * (position - lower)
+
+    return result
@@ -1,133 +1,144 @@
-import requests
 import pandas as pd
 import os
-import zipfile
-import time
-import geopandas as gpd
-from shapely.geometry import LineString
-
-import plotly.colors as pc
-import plotly.express as px
-import plotly.graph_objects as go
-
-#take shapes.txt df, add segments together, and compute length in meters
-def aggregate_shapes(shapes):
-    #create geopandas dataframe from shapes. use shape_pt_lon,shape_pt_lat
-    #create line objects from shape_pt_lon, shape_pt_lat    
-    gdf = gpd.GeoDataFrame(shapes, geometry=gpd.points_from_xy(shapes['shape_pt_lon'], shapes['shape_pt_lat']))
-    lines = gpd.GeoDataFrame()
-
-    #create line objects from points
-    for shape_id in gdf.shape_id.unique():
-        points = gdf[gdf['shape_id'] == shape_id]
-
-        #create a single linestring from the points
-        line = LineString(points.geometry)
-        lines = pd.concat([lines, pd.DataFrame({'shape_id': [shape_id], 'geometry': [line]})], ignore_index=True)
-    
-    lines = lines[['shape_id', 'geometry']]
-    lines = gpd.GeoDataFrame(lines, geometry='geometry').set_crs(epsg=4326).to_crs(epsg=26910)
-    lines['length'] = lines.geometry.length
-    lines = lines.to_crs(epsg=4326)
-
-    #sort by shape_id
-    lines = lines.sort_values(by='shape_id')    
-    lines = lines.reset_index(drop=True)
-    return lines
-
-def analyze_feeds():
-   
-    #create df with columns date, route, runtime, headways
-    main_df = pd.DataFrame(columns=['date', 'route_short_name', 'departure_time', 'runtime', 'speed'])
-
-    for folder in os.listdir("Historical Feeds"):
-    #for folder in ['gtfs-2023', 'gtfs-2024']:
-        print(folder)
-        calendar = pd.read_csv("Historical Feeds/" + folder + "/calendar.txt")
-        calendar['start_date'] = pd.to_datetime(calendar['start_date'], format='%Y%m%d')
-        calendar['end_date'] = pd.to_datetime(calendar['end_date'], format='%Y%m%d')
-
-        calendar = calendar.sort_values(by='start_date')
-
-        calendar = calendar[calendar.monday == 1]
-
-        def contains_desired_date(start_date, end_date):
-            #target date: sept 20 (arbitrary) of whatever year start_date is in
-            target_date = pd.to_datetime(str(start_date.year) + "-09-20")
-            if start_date <= target_date and end_date >= target_date:
-                return True
-            return False
-        
-        calendar['Contains Sept'] = calendar.apply(lambda x: contains_desired_date(x['start_date'], x['end_date']), axis=1)
 
-        service_ids = calendar[calendar['Contains Sept'] == True]
-        service_date = service_ids['start_date'].iloc[0]
+import render_pool
+from gtfs_tables import feed_version, open_feed, load_table, load_shapes
+from cache_utils import cache_key, cache_path, prune_cache
 
-        if service_date in main_df.date:
-            print(folder + ": service date already in database")
-            continue
+feed_columns = ['date', 'route_short_name', 'trip_headsign', 'departure_time', 'runtime', 'speed']
 
-        routes = pd.read_csv("Historical Feeds/" + folder + "/routes.txt")
-        trips = pd.read_csv("Historical Feeds/" + folder + "/trips.txt")
-        stop_times = pd.read_csv("Historical Feeds/" + folder + "/stop_times.txt")
-        shapes = pd.read_csv("Historical Feeds/" + folder + "/shapes.txt")
-        shapes = aggregate_shapes(shapes)
-        
-        #filter trips and stop_times by service_id
-        trips = trips[trips['service_id'].isin(service_ids.service_id)]
-        trips = trips.merge(routes[['route_id', 'route_short_name']])
-        stop_times = stop_times[stop_times.trip_id.isin(trips.trip_id)]
-        
-        # Remove trip_ids where any stop_time has arrival_time or departure_time starting with 24, 25, or 26
-        mask = stop_times['arrival_time'].str.startswith(('24', '25', '26')) | stop_times['departure_time'].str.startswith(('24', '25', '26'))
-        bad_trip_ids = stop_times.loc[mask, 'trip_id'].unique()
-        stop_times = stop_times[~stop_times['trip_id'].isin(bad_trip_ids)]
+#Key for one feed's results: the feed's version (content hash). Bump the string when analyze_feed changes what it produces
+def feed_key(version):
+    return cache_key("feed runtimes v3", version)
 
-        stop_times['arrival_time'] = pd.to_datetime(stop_times['arrival_time'], format='%H:%M:%S')
-        stop_times['departure_time'] = pd.to_datetime(stop_times['departure_time'], format='%H:%M:%S')
+def feed_runtimes_path(folder, key):
+    return cache_path(os.path.join("feed_runtimes", folder), key)
 
-        #aggregate stop_times by trip_id, get first and last stop times. Calculate runtime
-        stop_times = stop_times.groupby('trip_id').agg({'arrival_time': ['min', 'max'], 'departure_time': 'min'})
-        stop_times['runtime'] = stop_times['arrival_time']['max'] - stop_times['arrival_time']['min']
+#Trip runtimes and speeds on the september service date of one historical feed. Tables come from the parsed GTFS cache
+def analyze_feed(folder, version):
+    print(folder)
+    calendar = load_table(version, "calendar")
+    calendar['start_date'] = pd.to_datetime(calendar['start_date'], format='%Y%m%d')
+    calendar['end_date'] = pd.to_datetime(calendar['end_date'], format='%Y%m%d')
 
-        stop_times = stop_times.sort_values(by=('departure_time','min'))
-        stop_times.reset_index(inplace=True)
-        stop_times = stop_times[['trip_id', 'runtime', 'departure_time']].reset_index()
-        stop_times = stop_times.droplevel(1, axis=1)
+    calendar = calendar.sort_values(by='start_date')
 
-        #add route_short_name and shape_id to stop_times
-        stop_times = stop_times.merge(trips[['trip_id', 'route_short_name', 'trip_headsign', 'shape_id']])
-        
-        #convert runtime to minutes. Int object
-        stop_times['runtime'] = stop_times['runtime'].dt.seconds / 60
+    calendar = calendar[calendar.monday == 1]
+
+    def contains_desired_date(start_date, end_date):
+        #target date: sept 20 (arbitrary) of whatever year start_date is in
+        target_date = pd.to_datetime(str(start_date.year) + "-09-20")
+        if start_date <= target_date and end_date >= target_date:
+            return True
+        return False
+    
+    calendar['Contains Sept'] = calendar.apply(lambda x: contains_desired_date(x['start_date'], x['end_date']), axis=1)
+
+    service_ids = calendar[calendar['Contains Sept'] == True]
+    service_date = service_ids['start_date'].iloc[0]
+
+    routes = load_table(version, "routes", ['route_id', 'route_short_name'])
+    trips = load_table(version, "trips", ['route_id', 'service_id', 'trip_id', 'trip_headsign', 'shape_id'])
+    stop_times = load_table(version, "stop_times", ['trip_id', 'arrival_time', 'departure_time'])
+    shapes = load_shapes(version)
+    
+    #filter trips and stop_times by service_id
+    trips = trips[trips['service_id'].isin(service_ids.service_id)]
+    trips = trips.merge(routes[['route_id', 'route_short_name']])
+    stop_times = stop_times[stop_times.trip_id.isin(trips.trip_id)]
+
+    #aggregate stop_times by trip_id, get first and last stop times (seconds after midnight). Calculate runtime.
+    #Trips running past midnight (hours of 24 and up) are kept
+    stop_times = stop_times.groupby('trip_id', observed=True).agg(
+        first_arrival=('arrival_time', 'min'), last_arrival=('arrival_time', 'max'), departure_time=('departure_time', 'min')).reset_index()
+    stop_times['runtime'] = stop_times['last_arrival'] - stop_times['first_arrival']
+
+    stop_times = stop_times.sort_values(by='departure_time')
+    stop_times['trip_id'] = stop_times['trip_id'].astype(str)
+    #departure as a time of day on 1900-01-01 for the graphs. Departures after midnight fall on the 2nd
+    stop_times['departure_time'] = pd.Timestamp('1900-01-01') + pd.to_timedelta(stop_times['departure_time'], unit='s')
+    stop_times = stop_times[['trip_id', 'runtime', 'departure_time']]
+
+    #add route_short_name and shape_id to stop_times
+    stop_times = stop_times.merge(trips[['trip_id', 'route_short_name', 'trip_headsign', 'shape_id']])
+    
+    #convert runtime to minutes
+    stop_times['runtime'] = stop_times['runtime'] / 60
+    
+    #select a specific, consistent direction for the analysis.
+    frames = []
+    keywords = ['UVic', 'Downtown', 'James Bay']
+    for route in trips.route_short_name.unique():
+        route_headsigns = trips[trips.route_short_name == route].trip_headsign.unique()
+        for keyword in keywords:
+            #if any of route_headsigns contain the keyword, use that as the headsign_keyword
+            headsign_keyword = next((headsign for headsign in route_headsigns if keyword.lower() in headsign.lower()), None)
+            if headsign_keyword is not None:
+                break
+        if headsign_keyword is None:
+            continue
         
-        #select a specific, consistent direction for the analysis.
-        keywords = ['UVic', 'Downtown', 'James Bay']
-        for route in trips.route_short_name.unique():
-            route_headsigns = trips[trips.route_short_name == route].trip_headsign.unique()
-            for keyword in keywords:
-                #if any of route_headsigns contain the keyword, use that as the headsign_keyword
-                headsign_keyword = next((headsign for headsign in route_headsigns if keyword.lower() in headsign.lower()), None)
-                if headsign_keyword is not None:
-                    break
-            if headsign_keyword is None:
-                continue
-            
-            #filter stop_times by route number and headsign_keyword
-            route_stop_times = stop_times[stop_times['route_short_name'] == route]
-            route_stop_times = route_stop_times[route_stop_times['trip_headsign'].str.contains(headsign_keyword)]
-
-            #merge with shapes
-            route_stop_times = route_stop_times.merge(shapes[['shape_id', 'length']], on='shape_id')
-
-            #Filter out short-turn trips
-            pivot = route_stop_times.pivot_table(index='route_short_name', values='length', aggfunc='median')
-            route_stop_times = route_stop_times[route_stop_times['length'] > 0.9*pivot.loc[route]['length']]
-
-            route_stop_times['speed'] = (route_stop_times['length']/1000) / (route_stop_times['runtime'] / 60)
-            route_stop_times['date'] = service_date
-          
-            main_df = pd.concat([main_df, route_stop_times[['date', 'route_short_name', 'trip_headsign', 'departure_time', 'runtime', 'speed']]], ignore_index=True)
+        #filter stop_times by route number and headsign_keyword
+        route_stop_times = stop_times[stop_times['route_short_name'] == route]
+        route_stop_times = route_stop_times[route_stop_times['trip_headsign'].str.contains(headsign_keyword)]
+
+        #merge with shapes
+        route_stop_times = route_stop_times.merge(shapes[['shape_id', 'length']], on='shape_id')
+
+        #Filter out short-turn trips
+        pivot = route_stop_times.pivot_table(index='route_short_name', values='length', aggfunc='median')
+        route_stop_times = route_stop_times[route_stop_times['length'] > 0.9*pivot.loc[route]['length']]
+
+        route_stop_times['speed'] = (route_stop_times['length']/1000) / (route_stop_times['runtime'] / 60)
+        route_stop_times['date'] = service_date
+      
+        frames.append(route_stop_times[feed_columns])
+
+    if not frames:
+        return pd.DataFrame(columns=feed_columns)
+    return pd.concat(frames, ignore_index=True)
+
+#analyze_feed in a worker process (converting the feed into the GTFS cache first if needed), saving the result under the feed's key
+def build_feed_runtimes(job):
+    folder, key = job
+    feed_df = analyze_feed(folder, open_feed("Historical Feeds/" + folder))
+
+    path = feed_runtimes_path(folder, key)
+    feed_df.to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    prune_cache(os.path.join("feed_runtimes", folder), key)
+    return feed_df
+
+#Past feeds never change, so each feed's results are cached on its contents and only new or replaced feeds are analyzed,
+#in parallel worker processes. Adding a year's feed only reads that feed
+def analyze_feeds(workers = None):
+    #gtfs-YYYY folders, oldest first. Which feed keeps a shared service date mustn't depend on directory order
+    folders = sorted(os.listdir("Historical Feeds"))
+
+    feed_dfs = {}
+    pending = []
+    for folder in folders:
+        key = feed_key(feed_version("Historical Feeds/" + folder))
+        if os.path.exists(feed_runtimes_path(folder, key)):
+            feed_dfs[folder] = pd.read_parquet(feed_runtimes_path(folder, key))
+        else:
+            pending.append((folder, key))
+
+    for (folder, key), feed_df in zip(pending, render_pool.map_all(build_feed_runtimes, pending, workers=workers)):
+        feed_dfs[folder] = feed_df
+
+    #create df with columns date, route, runtime, headways. A feed whose service date is already covered by an older one is skipped
+    frames = []
+    dates = set()
+    for folder in folders:
+        feed_df = feed_dfs[folder]
+        feed_dates = set(feed_df.date)
+        if feed_dates & dates:
+            print(folder + ": service date already in database")
+            continue
+        dates |= feed_dates
+        frames.append(feed_df)
+    main_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=feed_columns)
 
     #Route 50 was renumbered to be 95 in 2023. Replace all values of route_short_name 50 with 95
     main_df = main_df.replace({'route_short_name': {50 : 95}})
@@ -136,6 +147,10 @@ def analyze_feeds():
     main_df = main_df.replace({'route_short_name': {5 : 2}})
     
     #CREATE GRAPHS
+    #plotly is imported here rather than at the top so importing this module stays fast
+    import plotly.colors as pc
+    import plotly.express as px
+
     df = main_df.copy()
     df.date = df.date.dt.year
     scale = px.colors.diverging.RdYlBu_r
@@ -146,38 +161,50 @@ def analyze_feeds():
     routes = sorted(df.route_short_name.unique())
     years = sorted(df.date.unique())
     
-    for route in routes:
-        fig = go.Figure()
+    #one figure per route, rendered in parallel. Each job only carries its own route's trips
+    jobs = [(route, df[df.route_short_name == route], years, colours) for route in routes]
+    render_pool.render_all(render_historical_runtimes, jobs, workers=workers)
 
-        for j in range(0, len(years)):
-            date = years[j]
-            series = df[(df.route_short_name == route) & (df.date == date)]
+    return
 
-            colour = colours[j]
+def render_historical_runtimes(job):
+    import plotly.graph_objects as go
 
-            #add line and plot departure_time vs speed. no marker
-            fig.add_trace(go.Scatter(x=series.departure_time, y=series.runtime, mode='lines', name=str(date), line=dict(color=colour)))
+    route, route_df, years, colours = job
+    fig = go.Figure()
 
-        #add title
-        fig.update_layout(
-            template='plotly_dark',
-            title="End-to-end runtimes over time: route " + str(route),
-            title_x=0.5
-        )
+    for j in range(0, len(years)):
+        date = years[j]
+        series = route_df[route_df.date == date]
 
-        #add interactive legend on the right
-        fig.update_layout(
-            legend=dict(
-                orientation="h",
-                yanchor="bottom",
-                y=1.02,
-                xanchor="right",
-                x=1
-            )
+        colour = colours[j]
+
+        #add line and plot departure_time vs speed. no marker
+        fig.add_trace(go.Scatter(x=series.departure_time, y=series.runtime, mode='lines', name=str(date), line=dict(color=colour)))
+
+    #add title
+    fig.update_layout(
+        template='plotly_dark',
+        title="End-to-end runtimes over time: route " + str(route),
+        title_x=0.5
+    )
+
+    #add interactive legend on the right
+    fig.update_layout(
+        legend=dict(
+            orientation="h",
+            yanchor="bottom",
+            y=1.02,
+            xanchor="right",
+            x=1
         )
+    )
+
+    fig.write_html('docs/plots/historical_runtimes/route ' + str(route) + '.html')
 
-        fig.write_html('docs/plots/historical_runtimes/route ' + str(route) + '.html')
-    
     return
+
 #download_feeds()
-analyze_feeds()
\ No newline at end of file
+#worker processes re-import this module, so only run when called directly
+if __name__ == "__main__":
+    analyze_feeds()
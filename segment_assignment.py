@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from cache_utils import cache_folder, cache_key, prune_cache
+import timeline_store
+
+#Which road segment buffer(s) each ping falls in. Pings never move, so the answer is saved per service date and reused
+#until the segment network changes. Only pings that aren't in the saved index yet go through the spatial join.
+#Index files: cache/segment_assignment/<network key>/<service_date>.parquet with columns ping_key, buffer_id (-1 = no segment)
+
+#Stable key for each ping, from the columns that identify it. Identical pings share a key, and since they share a location they share an assignment too.
+#Columns are normalised first so the full and compact timeline schemas give the same keys
+def ping_keys(timeline):
+    key_columns = pd.DataFrame({
+        "Time": timeline["Time"].to_numpy().astype(np.int64),
+        "Trip ID": timeline["Trip ID"].to_numpy().astype(np.int64),
+        "x": timeline["x"].to_numpy().astype(np.float32),
+        "y": timeline["y"].to_numpy().astype(np.float32)
+    })
+    return pd.util.hash_pandas_object(key_columns, index=False).to_numpy()
+
+#Fingerprint of the segment network: geometries, ids and buffer distance
+def network_key(route_segments, buffer_distance = 20):
+    geometry_hash = pd.util.hash_pandas_object(pd.Series(shapely.to_wkb(route_segments.geometry.to_numpy())), index=False).sum()
+    id_hash = pd.util.hash_pandas_object(route_segments.index.to_series(), index=False).sum()
+    return cache_key("ping keys v2", int(geometry_hash), int(id_hash), buffer_distance)
+
+#Spatially join pings that aren't in the index yet. Returns ping_key, buffer_id for every new ping, with -1 for pings outside every buffer
+def assign_new_pings(keys, points, tree, buffer_ids):
+    keys, first = np.unique(keys, return_index=True)
+    ping_idx, buffer_idx = tree.query(points[first], predicate="intersects")
+
+    assigned = pd.DataFrame({"ping_key": keys[ping_idx], "buffer_id": buffer_ids[buffer_idx]})
+    missing = np.setdiff1d(np.arange(len(keys)), ping_idx)
+    unassigned = pd.DataFrame({"ping_key": keys[missing], "buffer_id": np.full(len(missing), -1, dtype=np.int64)})
+
+    return pd.concat([assigned, unassigned], ignore_index=True)
+
+#Remove the indexes of every other segment network. Called once from the main process before any workers start
+#(speed_partials.update_all): workers pruning the same old folder at once would trip over each other's deletions
+def prune_assignments(route_segments, buffer_distance = 20):
+    key = network_key(route_segments, buffer_distance)
+    os.makedirs(os.path.join(cache_folder, "segment_assignment", key), exist_ok=True)
+    prune_cache("segment_assignment", key)
+    return
+
+#Returns (ping_key, buffer_id) for every ping in timeline that falls within a segment buffer. A ping in overlapping buffers appears once per buffer
+def assign_segments(timeline, route_segments, buffer_distance = 20):
+    key = network_key(route_segments, buffer_distance)
+    folder = os.path.join(cache_folder, "segment_assignment", key)
+    os.makedirs(folder, exist_ok=True)
+
+    buffers = route_segments.buffer(buffer_distance, cap_style=2)
+    tree = None
+    buffer_ids = route_segments.index.to_numpy().astype(np.int64)
+
+    keys = ping_keys(timeline)
+    if 'service_date' in timeline.columns:
+        service_dates = timeline['service_date'].to_numpy()
+    else:
+        service_dates = timeline_store.service_date_key(timeline['Time'])
+
+    results = []
+    for service_date in np.unique(service_dates):
+        in_date = service_dates == service_date
+        path = os.path.join(folder, str(service_date) + ".parquet")
+
+        if os.path.exists(path):
+            index = pd.read_parquet(path)
+        else:
+            index = pd.DataFrame({"ping_key": np.array([], dtype=np.uint64), "buffer_id": np.array([], dtype=np.int64)})
+
+        new = in_date.copy()
+        new[in_date] = ~np.isin(keys[in_date], index.ping_key.to_numpy())
+
+        if new.any():
+            #only build the tree if there's something to assign
+            if tree is None:
+                tree = shapely.STRtree(buffers.to_numpy())
+            points = timeline_store.ping_points(timeline, new)
+            index = pd.concat([index, assign_new_pings(keys[new], points, tree, buffer_ids)], ignore_index=True)
+            #files sharing a boundary date can be assigned in parallel workers. Writing through a per-process temporary file keeps
+            #the index readable, and at worst one worker's additions are lost and get assigned again next time
+            index.to_parquet(path + f".{os.getpid()}.tmp", index=False)
+            os.replace(path + f".{os.getpid()}.tmp", path)
+
+        results.append(index[index.ping_key.isin(keys[in_date]) & (index.buffer_id >= 0)])
+
+    return pd.concat(results, ignore_index=True)
+
+#Which corridor(s) each ping counts towards: within the corridor's buffer and on one of the routes that serve it (corridor_routes: corridor name, Route).
+#Returns (row position in timeline, corridor name) pairs. A ping counts once per corridor, even if the corridor has several pieces
+def assign_corridors(timeline, corridors, corridor_routes, buffer_distance = 20):
+    #points are only needed for routes that serve some corridor
+    rows = np.flatnonzero(timeline.Route.astype(str).isin(corridor_routes.Route).to_numpy())
+    points = timeline_store.ping_points(timeline, rows)
+
+    buffers = corridors.buffer(buffer_distance, cap_style=2).to_numpy()
+    point_idx, buffer_idx = shapely.STRtree(buffers).query(points, predicate="within")
+
+    pairs = pd.DataFrame({"row": rows[point_idx], "corridor name": corridors['corridor name'].to_numpy()[buffer_idx]}).drop_duplicates()
+    pairs['Route'] = timeline.Route.astype(str).to_numpy()[pairs.row.to_numpy()]
+    pairs = pairs.merge(corridor_routes, on=["corridor name", "Route"])
+
+    return pairs.row.to_numpy(), pairs['corridor name'].to_numpy()
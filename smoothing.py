@@ -0,0 +1,35 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+#Percentile of each centred rolling window, for every window at once. Same windows as
+#Series.rolling(window, min_periods=1, center=True) and the same (linear) interpolation as np.percentile. Values must not contain NaN
+def rolling_percentile(values, q, window = 10):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return values
+
+    #pad both ends with NaN so the edge windows are just shorter. np.sort puts the NaN padding last in each window
+    before = window // 2
+    after = window - 1 - before
+    padded = np.concatenate([np.full(before, np.nan), values, np.full(after, np.nan)])
+    windows = np.sort(sliding_window_view(padded, window), axis=1)
+
+    count = window - np.isnan(windows).sum(axis=1)
+    position = (count - 1) * q / 100
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, count - 1)
+    fraction = position - lower
+
+    rows = np.arange(len(values))
+    return windows[rows, lower] + (windows[rows, upper] - windows[rows, lower]) * fraction
+
+#statsmodels LOWESS with an explicit speed/accuracy setting. Points within delta_fraction of the x range of the last fitted point
+#are linearly interpolated instead of getting their own local regression (statsmodels' delta). 0 gives the exact fit.
+#The number of local fits is bounded by about 1/delta_fraction however many points there are, so long windows stay fast
+def lowess(y, x, frac = .3, delta_fraction = 0.01):
+    #statsmodels is slow to import and only needed here
+    import statsmodels.api as sm
+
+    x = np.asarray(x, dtype=np.float64)
+    delta = delta_fraction * (x.max() - x.min()) if len(x) else 0.0
+    return sm.nonparametric.lowess(y, x, frac=frac, delta=delta)
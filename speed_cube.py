@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+from cache_utils import cache_key, cache_path, prune_cache
+
+#Speed sums and ping counts by segment (buffer_id), weekday and hour, added up from the segment speed partials.
+#Every system map is derived from this, so new variants (other peak windows, weekday-only) don't need another scan.
+#Stored long-form: one row per (buffer_id, Weekday, Hour) that has at least one ping.
+#Each file is keyed by the service date window it covers (date keys, None for an open end), so a cube built for one window is
+#never read back as another's. Only the most recently saved window is kept
+def cube_key(start_date = None, end_date = None):
+    window = [None if date is None else int(date) for date in (start_date, end_date)]
+    return cache_key("speed cube v1", window)
+
+def cube_path(start_date = None, end_date = None):
+    return cache_path("speed_cube", cube_key(start_date, end_date))
+
+#The cube from segment partials merged by weekday and hour (speed_partials.merge_partials("segment", by=["weekday", "hour"]))
+def cube_from_partials(merged):
+    return pd.DataFrame({
+        "buffer_id": merged.buffer_id.to_numpy(),
+        "Weekday": merged.weekday.to_numpy().astype(np.int8),
+        "Hour": merged.hour.to_numpy().astype(np.int8),
+        "speed_sum": merged.speed_sum.to_numpy(),
+        "count": merged['count'].to_numpy()
+    })
+
+def save_speed_cube(cube, start_date = None, end_date = None):
+    cube.to_parquet(cube_path(start_date, end_date), index=False)
+    prune_cache("speed_cube", cube_key(start_date, end_date))
+    return
+
+def load_speed_cube(start_date = None, end_date = None):
+    return pd.read_parquet(cube_path(start_date, end_date))
+
+def filter_cube(cube, hours = None, weekdays = None):
+    if hours is not None:
+        cube = cube[cube.Hour.isin(hours)]
+    if weekdays is not None:
+        cube = cube[cube.Weekday.isin(weekdays)]
+    return cube
+
+#Mean speed per segment over the selected hours/weekdays. Segments with no pings in the selection are left out
+def mean_speed(cube, hours = None, weekdays = None):
+    totals = filter_cube(cube, hours, weekdays).groupby("buffer_id")[["speed_sum", "count"]].sum()
+    return (totals.speed_sum / totals["count"]).rename("Speed")
+
+#Mean speed per segment for each hour of the day. Columns 0-23, NaN where a segment has no pings in that hour
+def hourly_speed(cube, weekdays = None):
+    totals = filter_cube(cube, weekdays=weekdays).groupby(["buffer_id", "Hour"])[["speed_sum", "count"]].sum()
+    hourly = (totals.speed_sum / totals["count"]).unstack("Hour")
+    return hourly.reindex(columns=range(24))
+
+#Slowest (peak) and fastest (off-peak) three-hour window per segment, from the mean of the hourly means in each window
+def peak_delta(cube, weekdays = None):
+    hourly = hourly_speed(cube, weekdays)
+    values = hourly.to_numpy()
+    present = ~np.isnan(values)
+    values = np.where(present, values, 0)
+
+    #windows centred on hours 1-21: 0-1-2 through 20-21-22
+    window_sum = values[:, 0:21] + values[:, 1:22] + values[:, 2:23]
+    window_count = present[:, 0:21].astype(int) + present[:, 1:22] + present[:, 2:23]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        windows = pd.DataFrame(window_sum / window_count, index=hourly.index, columns=["{}-{}-{}".format(i-1, i, i+1) for i in range(1, 22)])
+
+    delta = pd.DataFrame(index=hourly.index)
+    delta['Peak'] = windows.min(axis=1).round(1)
+    delta['Peak Hour'] = windows.idxmin(axis=1)
+    delta['Off-Peak'] = windows.max(axis=1).round(1)
+    delta['Off-Peak Hour'] = windows.idxmax(axis=1)
+    delta['Speed Delta'] = delta['Off-Peak'] - delta['Peak']
+
+    return delta
@@ -0,0 +1,157 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from cache_utils import cache_folder, cache_key
+from segment_assignment import assign_segments, assign_corridors, ping_keys, network_key, prune_assignments
+import timeline_store
+import render_pool
+
+#Partial speed aggregates for each source (csv) file: speed sum, sum of squares and ping count by key (segment, route or
+#corridor), service date, hour and weekday. A file's pings are aggregated once, when the file is first seen or when what its
+#keys depend on changes (segment network, corridor definitions). Adding a week of data only reads that week's pings.
+#Any date window is answered by adding up the partials that overlap it, so averages (and spreads) never need the raw history.
+#Files: cache/speed_partials/<kind>/<source>.parquet. <kind>/_sources.json records the key and date range each file was built with
+partials_folder = os.path.join(cache_folder, "speed_partials")
+
+#kind: name of the key column
+kinds = {"segment": "buffer_id", "route": "Route", "corridor": "corridor name"}
+
+partial_columns = ["Time", "Route", "Trip ID", "Speed", "x", "y", "utm_x", "utm_y", "service_date", "hour", "weekday"]
+
+def partial_path(kind, source):
+    return os.path.join(partials_folder, kind, source + ".parquet")
+
+def sources_path(kind):
+    return os.path.join(partials_folder, kind, "_sources.json")
+
+def read_sources(kind):
+    if not os.path.exists(sources_path(kind)):
+        return {}
+    with open(sources_path(kind)) as f:
+        return json.load(f)
+
+def write_sources(kind, sources):
+    os.makedirs(os.path.dirname(sources_path(kind)), exist_ok=True)
+    with open(sources_path(kind) + ".tmp", "w") as f:
+        json.dump(sources, f, indent=1, sort_keys=True)
+    os.replace(sources_path(kind) + ".tmp", sources_path(kind))
+
+#Sum, sum of squares and count of speed by key, service date, hour and weekday
+def build_partials(key, service_date, hour, weekday, speed):
+    speed = np.asarray(speed, dtype=np.float64)
+    pings = pd.DataFrame({"key": key, "service_date": service_date, "hour": hour, "weekday": weekday, "speed": speed, "speed_sq": speed * speed})
+    return pings.groupby(["key", "service_date", "hour", "weekday"], sort=True).agg(
+        speed_sum=("speed", "sum"), speed_sq_sum=("speed_sq", "sum"), count=("speed", "size")).reset_index()
+
+#Each member function returns (row positions, key values) for the pings that belong to some key. A ping can belong to several
+def route_members(pings):
+    return np.arange(len(pings)), pings.Route.astype(str).to_numpy()
+
+def segment_members(pings, route_segments):
+    assignment = assign_segments(pings, route_segments)
+    rows = pd.DataFrame({"ping_key": ping_keys(pings), "row": np.arange(len(pings))}).merge(assignment, on="ping_key")
+    return rows.row.to_numpy(), rows.buffer_id.to_numpy()
+
+def corridor_members(pings, corridors, corridor_routes):
+    return assign_corridors(pings, corridors, corridor_routes)
+
+#Fingerprint of the corridor buffers and the routes that count towards each
+def corridor_key(corridors, corridor_routes):
+    geometry_hash = pd.util.hash_pandas_object(pd.Series(shapely.to_wkb(corridors.geometry.to_numpy())), index=False).sum()
+    return cache_key(int(geometry_hash), list(corridors['corridor name']), corridor_routes.sort_values(by=["corridor name", "Route"]).values.tolist())
+
+#Partials of one kind for one source file, built in a worker process. Only that file's pings are loaded.
+#The segment network and corridors come from render_pool.shared, sent once per worker
+def build_source_partials(job):
+    kind, source = job
+    route_segments, corridors, corridor_routes = render_pool.shared
+
+    pings = timeline_store.read_source(source, partial_columns)
+    if kind == "route":
+        rows, values = route_members(pings)
+    elif kind == "segment":
+        rows, values = segment_members(pings, route_segments)
+    else:
+        rows, values = corridor_members(pings, corridors, corridor_routes)
+
+    partials = build_partials(values, pings.service_date.to_numpy()[rows], pings.hour.to_numpy()[rows], pings.weekday.to_numpy()[rows], pings.Speed.to_numpy()[rows])
+    partials = partials.rename(columns={"key": kinds[kind]})
+
+    partials.to_parquet(partial_path(kind, source) + ".tmp", index=False)
+    os.replace(partial_path(kind, source) + ".tmp", partial_path(kind, source))
+    return job
+
+#Build partials for every (kind, source file) that doesn't have up-to-date ones, one file per job across a pool of workers.
+#A file is rebuilt when its manifest entry or what its keys depend on (segment network, corridor definitions) changes.
+#Partials of sources no longer in the store are removed
+def update_all(route_segments, corridors, corridor_routes, workers = None):
+    networks = {"route": "route", "segment": network_key(route_segments), "corridor": corridor_key(corridors, corridor_routes)}
+    manifest = timeline_store.read_manifest()
+
+    jobs = {}
+    for kind, network in networks.items():
+        os.makedirs(os.path.join(partials_folder, kind), exist_ok=True)
+        sources = read_sources(kind)
+        for filename, entry in sorted(manifest.items()):
+            source = filename[:-len(".csv")]
+            key = cache_key(entry, network)
+            if source in sources and sources[source]["key"] == key and os.path.exists(partial_path(kind, source)):
+                continue
+            print(f"Aggregating {kind} speeds for {source}")
+            jobs[(kind, source)] = {"key": key, "start": entry["start"], "end": entry["end"]}
+
+    #indexes of an old segment network are removed here, once, rather than by every worker
+    prune_assignments(route_segments)
+    render_pool.map_all(build_source_partials, list(jobs), shared_data=(route_segments, corridors, corridor_routes), workers=workers)
+
+    for kind in networks:
+        sources = read_sources(kind)
+        for (job_kind, source), record in jobs.items():
+            if job_kind == kind:
+                sources[source] = record
+        for source in [source for source in sources if source + ".csv" not in manifest]:
+            if os.path.exists(partial_path(kind, source)):
+                os.remove(partial_path(kind, source))
+            del sources[source]
+        write_sources(kind, sources)
+    return
+
+#Add up the partials of one kind over a service date window (YYYYMMDD ints, either end open) and optional hours/weekdays.
+#Grouped by the key plus any of service_date, hour and weekday listed in by. Only files overlapping the window are read
+def merge_partials(kind, start_date = None, end_date = None, hours = None, weekdays = None, by = ()):
+    key_column = kinds[kind]
+    group = [key_column] + list(by)
+
+    frames = []
+    for source, entry in sorted(read_sources(kind).items()):
+        if start_date is not None and entry["end"] < start_date:
+            continue
+        if end_date is not None and entry["start"] > end_date:
+            continue
+        frames.append(pd.read_parquet(partial_path(kind, source)))
+
+    if not frames:
+        return pd.DataFrame(columns=group + ["speed_sum", "speed_sq_sum", "count"])
+    partials = pd.concat(frames, ignore_index=True)
+
+    if start_date is not None:
+        partials = partials[partials.service_date >= start_date]
+    if end_date is not None:
+        partials = partials[partials.service_date <= end_date]
+    if hours is not None:
+        partials = partials[partials.hour.isin(hours)]
+    if weekdays is not None:
+        partials = partials[partials.weekday.isin(weekdays)]
+
+    return partials.groupby(group, sort=True)[["speed_sum", "speed_sq_sum", "count"]].sum().reset_index()
+
+#Mean and (population) standard deviation of speed from merged partials
+def speed_stats(merged):
+    merged = merged.copy()
+    merged['Speed'] = merged.speed_sum / merged['count']
+    merged['Speed SD'] = np.sqrt(np.maximum(merged.speed_sq_sum / merged['count'] - merged.Speed ** 2, 0))
+    return merged
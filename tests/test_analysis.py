@@ -0,0 +1,23 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+import analysis
+
+def pings(trip_ids):
+    return pd.DataFrame({"Time": [1_725_200_000, 1_725_201_200] * len(trip_ids), "Route": "4", "Header": 1,
+                         "Trip ID": [trip_id for trip_id in trip_ids for ping in range(2)], "Speed": 20.0,
+                         "service_date": 20240901, "weekday": 6})
+
+def test_trip_keys_decode_back_to_their_service_date():
+    trips = analysis.summarize_trip_data(pings([0, 2**32 - 1]), header_text=False)
+
+    assert list(trips.Date) == [datetime.date(2024, 9, 1)] * 2
+    assert list(trips.custom_id & (2**32 - 1)) == [0, 2**32 - 1]
+    assert list(trips.runtime) == [20.0, 20.0]
+
+@pytest.mark.parametrize("trip_id", [-1, 2**32])
+def test_trip_ids_that_would_spill_into_the_date_bits_are_refused(trip_id):
+    with pytest.raises(ValueError, match="32 bits"):
+        analysis.summarize_trip_data(pings([5, trip_id]), header_text=False)
@@ -0,0 +1,163 @@
+import io
+import os
+import json
+import time
+import hashlib
+import zipfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import download_data
+
+#A local stand-in for the Transitland API: a feed version listing, and downloads that honour Range requests.
+#Each feed is a zip of random bytes, a couple of download blocks (1MB) long, so half a feed is more than a block
+def make_feed(year):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("calendar.txt", f"service_id,monday,start_date,end_date\nWK,1,{year}0901,{year}1231\n")
+        archive.writestr("big.txt", os.urandom(1_500_000).hex())
+    return buffer.getvalue()
+
+class Transitland(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, headers = {}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.log.append((time.monotonic(), self.path, self.headers.get("Range")))
+
+        if self.path.startswith("/feed_versions?"):
+            versions = [{"sha1": sha1, "earliest_calendar_date": f"{year}-09-01", "latest_calendar_date": f"{year}-12-31"}
+                        for sha1, (year, data) in server.feeds.items()]
+            return self.send_body(200, json.dumps({"feed_versions": versions}).encode())
+
+        sha1 = self.path.split("/")[2]
+        year, data = server.feeds[sha1]
+        start = int(self.headers["Range"].split("=")[1].rstrip("-")) if self.headers.get("Range") else 0
+        if start >= len(data):
+            return self.send_body(416, b"")
+        status, headers = (206, {"Content-Range": f"bytes {start}-{len(data) - 1}/{len(data)}"}) if start else (200, {})
+
+        if sha1 in server.cut:
+            #promise the rest of the file, send half of it and hang up
+            server.cut.discard(sha1)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data) - start))
+            self.end_headers()
+            self.wfile.write(data[start:start + (len(data) - start) // 2])
+            self.close_connection = True
+            return
+        self.send_body(status, data[start:], headers)
+
+@pytest.fixture
+def transitland(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("TRANSITLAND_API_KEY", "test")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Transitland)
+    server.feeds = {}
+    for year in [2021, 2022, 2023]:
+        data = make_feed(year)
+        server.feeds[hashlib.sha1(data).hexdigest()] = (year, data)
+    server.log = []
+    server.lock = threading.Lock()
+    server.cut = set()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def sha1_of(server, year):
+    return [sha1 for sha1, (feed_year, data) in server.feeds.items() if feed_year == year][0]
+
+def part_path(sha1):
+    return os.path.join(download_data.transitland_folder, sha1 + ".zip.part")
+
+def download(server, **kwargs):
+    server.log.clear()
+    return download_data.download_transitland_feeds(base_url=server.url, **dict({"workers": 3, "requests_per_second": 50}, **kwargs))
+
+def downloads(server):
+    return [(path.split("/")[2], ranged) for when, path, ranged in server.log if path.endswith("/download")]
+
+def extracted(year):
+    with open(os.path.join(download_data.feeds_folder, f"gtfs-{year}", "calendar.txt")) as f:
+        return f.read()
+
+def test_downloads_and_extracts_every_year(transitland):
+    assert download(transitland) == {2021: "downloaded", 2022: "downloaded", 2023: "downloaded"}
+    for year in [2021, 2022, 2023]:
+        assert f"{year}0901" in extracted(year)
+    #nothing is left in progress
+    assert os.listdir(download_data.transitland_folder) == []
+
+def test_rerun_skips_versions_already_extracted(transitland):
+    download(transitland)
+    assert download(transitland) == {2021: "skipped", 2022: "skipped", 2023: "skipped"}
+    #only the listing was requested
+    assert len(transitland.log) == 1 and transitland.log[0][1].startswith("/feed_versions?")
+
+    #a different version of one year is fetched again, the rest are still skipped
+    marker = os.path.join(download_data.feeds_folder, "gtfs-2022", "_transitland.json")
+    with open(marker, "w") as f:
+        json.dump({"sha1": "older version", "year": 2022}, f)
+    assert download(transitland)[2022] == "downloaded"
+    assert downloads(transitland) == [(sha1_of(transitland, 2022), None)]
+
+def test_cut_connection_resumes_with_a_range_request(transitland):
+    sha1 = sha1_of(transitland, 2022)
+    transitland.cut.add(sha1)
+
+    assert download(transitland)[2022] == "downloaded"
+    #resumed from the blocks that made it to disk before the cut
+    first, second = [ranged for feed, ranged in downloads(transitland) if feed == sha1]
+    assert first is None
+    assert 0 < int(second[len("bytes="):-1]) <= len(transitland.feeds[sha1][1]) // 2
+    assert "20220901" in extracted(2022)
+
+def test_partial_file_from_an_earlier_run_is_resumed(transitland):
+    sha1 = sha1_of(transitland, 2021)
+    os.makedirs(download_data.transitland_folder)
+    with open(part_path(sha1), "wb") as f:
+        f.write(transitland.feeds[sha1][1][:100_000])
+
+    assert download(transitland)[2021] == "downloaded"
+    assert [ranged for feed, ranged in downloads(transitland) if feed == sha1] == ["bytes=100000-"]
+    assert "20210901" in extracted(2021)
+
+def test_corrupt_partial_file_starts_over(transitland):
+    sha1 = sha1_of(transitland, 2023)
+    os.makedirs(download_data.transitland_folder)
+    with open(part_path(sha1), "wb") as f:
+        f.write(b"x" * 1000)
+
+    assert download(transitland)[2023] == "downloaded"
+    assert [ranged for feed, ranged in downloads(transitland) if feed == sha1] == ["bytes=1000-", None]
+    assert "20230901" in extracted(2023)
+    assert not os.path.exists(part_path(sha1))
+
+def test_downloads_are_rate_limited_across_workers(transitland):
+    requests_per_second = 5
+    download(transitland, workers=3, requests_per_second=requests_per_second)
+
+    starts = sorted(when for when, path, ranged in transitland.log if path.endswith("/download"))
+    assert len(starts) == 3
+    #a little slack for the time between the limiter letting a request go and the server logging it
+    assert min(later - earlier for earlier, later in zip(starts, starts[1:])) > 0.8 / requests_per_second
@@ -0,0 +1,103 @@
+import os
+import glob
+
+import pandas as pd
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import download_from_mongodb
+import lookups
+
+from bson import ObjectId
+
+now = 1_730_000_000
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(download_from_mongodb.timeline_folder)
+    #fresh per-process lookup state
+    monkeypatch.setattr(lookups, "snapshots", {})
+    monkeypatch.setattr(lookups, "lookup_tables", {})
+    monkeypatch.setattr(lookups, "refreshed", set())
+
+    db = mongomock.MongoClient().Cluster0
+    db["headers"].insert_many([{"Header_ID": 1, "Header": "Downtown"}, {"Header_ID": 2, "Header": "UVic"}])
+    return db
+
+#a ping with the vehicle's timestamp time, inserted (its _id created) at epoch second inserted. A counter keeps _ids from the same second apart
+count = iter(range(10**6))
+
+def ping(time, inserted = None, trip = 1, **fields):
+    inserted = time if inserted is None else inserted
+    object_id = ObjectId(int(inserted).to_bytes(4, "big") + next(count).to_bytes(8, "big"))
+    return dict({"_id": object_id, "Time": time, "Route": "4", "Trip ID": trip, "Speed": 20.0, "Header": 1}, **fields)
+
+def exported_times():
+    files = sorted(glob.glob(download_from_mongodb.timeline_folder + "/*-timeline.csv"))
+    if not files:
+        return []
+    return sorted(pd.concat([pd.read_csv(path) for path in files]).Time)
+
+def test_export_stops_a_safety_lag_behind_now(db):
+    collection = db["transit_speed_data"]
+    collection.insert_many([ping(now - 3600), ping(now - 1000), ping(now - 60)])
+
+    download_from_mongodb.download_from_mongo(collection, now=now)
+    download_from_mongodb.clear_mongo(collection)
+
+    assert exported_times() == [now - 3600, now - 1000]
+    assert [document["Time"] for document in collection.find()] == [now - 60]
+
+def test_late_ping_after_export_is_kept_and_exported_next_time(db):
+    collection = db["transit_speed_data"]
+    collection.insert_many([ping(now - 3600), ping(now - 1000)])
+
+    download_from_mongodb.download_from_mongo(collection, now=now)
+    #arrives between the export and the clear, with a Time older than everything exported
+    collection.insert_one(ping(now - 5000, inserted=now - 30, trip=2))
+    download_from_mongodb.clear_mongo(collection)
+    assert [document["Time"] for document in collection.find()] == [now - 5000]
+
+    download_from_mongodb.download_from_mongo(collection, now=now + 600)
+    download_from_mongodb.clear_mongo(collection)
+    assert exported_times() == [now - 5000, now - 3600, now - 1000]
+    assert collection.count_documents({}) == 0
+
+def test_interrupted_clear_is_finished_without_exporting_twice(db):
+    collection = db["transit_speed_data"]
+    collection.insert_many([ping(now - 3600), ping(now - 1000)])
+
+    #exported, but the clear never ran
+    download_from_mongodb.download_from_mongo(collection, now=now)
+    collection.insert_one(ping(now - 500))
+
+    download_from_mongodb.download_from_mongo(collection, now=now + 600)
+    download_from_mongodb.clear_mongo(collection)
+    assert exported_times() == [now - 3600, now - 1000, now - 500]
+    assert collection.count_documents({}) == 0
+
+def test_a_field_missing_from_the_header_fails_the_export(db):
+    collection = db["transit_speed_data"]
+    collection.insert_many([ping(now - 3600), ping(now - 3500), ping(now - 3400, Occupancy=3)])
+
+    with pytest.raises(ValueError, match="Occupancy"):
+        download_from_mongodb.download_from_mongo(collection, batch_size=2, now=now)
+
+    #nothing is written and nothing can be cleared
+    assert exported_times() == []
+    assert not os.path.exists(download_from_mongodb.timeline_folder + "/export.csv.partial")
+    download_from_mongodb.clear_mongo(collection)
+    assert collection.count_documents({}) == 3
+
+def test_download_and_clear_against_an_injected_database(db, monkeypatch):
+    monkeypatch.delenv("MONGO_URL", raising=False)
+    monkeypatch.setattr(download_from_mongodb.time, "time", lambda: now)
+    db["transit_speed_data"].insert_many([ping(now - 3600), ping(now - 10)])
+
+    download_from_mongodb.download_and_clear(db)
+
+    assert exported_times() == [now - 3600]
+    assert db["transit_speed_data"].count_documents({}) == 1
+    assert list(lookups.header_names([2, 1])) == ["UVic", "Downtown"]
@@ -0,0 +1,27 @@
+import sys
+import json
+import subprocess
+
+from conftest import repo_folder
+
+#Importing the analysis modules used to take over 3s (plotly, keplergl, statsmodels and a MongoDB connection at import).
+#They're imported by notebooks and by every render worker, so the heavy imports stay inside the functions that need them
+import_budget = 1.0
+heavy_modules = ["plotly", "keplergl", "statsmodels", "pymongo", "gtfs_functions"]
+
+script = f"""
+import sys, json, time
+start = time.perf_counter()
+import analysis, schedules_over_time, pipeline
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "loaded": [name for name in {heavy_modules!r} if name in sys.modules]}}))
+"""
+
+def test_analysis_modules_import_fast_without_the_heavy_stack():
+    #a fresh interpreter, so nothing the other tests imported counts. The first run also warms the disk cache
+    for attempt in range(2):
+        result = subprocess.run([sys.executable, "-c", script], cwd=repo_folder, capture_output=True, text=True, check=True)
+        report = json.loads(result.stdout.strip().splitlines()[-1])
+
+    assert report["loaded"] == []
+    assert report["elapsed"] < import_budget, f"importing took {report['elapsed']:.2f}s (budget {import_budget}s)"
@@ -0,0 +1,28 @@
+import pytest
+
+import lookups
+
+@pytest.fixture
+def offline(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("MONGO_URL", raising=False)
+    monkeypatch.setattr(lookups, "snapshots", {})
+    monkeypatch.setattr(lookups, "lookup_tables", {})
+    monkeypatch.setattr(lookups, "refreshed", set())
+
+def test_missing_snapshot_without_a_database_gives_a_clear_error(offline):
+    with pytest.raises(RuntimeError, match="No local headers snapshot"):
+        lookups.header_names([1, 2])
+
+def test_refresh_is_incremental(offline):
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().Cluster0["headers"]
+    collection.insert_many([{"Header_ID": 1, "Header": "Downtown"}, {"Header_ID": 2, "Header": "UVic"}])
+    lookups.refresh_snapshot("headers", collection)
+
+    collection.insert_one({"Header_ID": 3, "Header": "James Bay"})
+    lookups.refresh_snapshot("headers", collection)
+    lookups.refresh_snapshot("headers", collection)
+
+    assert lookups.snapshot_version("headers") == 2
+    assert list(lookups.header_names([3, 1, 99])) == ["James Bay", "Downtown", None]
@@ -0,0 +1,33 @@
+import threading
+
+import pytest
+
+import pipeline
+
+@pytest.fixture(autouse=True)
+def in_tmp(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+def test_concurrent_stages_share_one_worker_budget(monkeypatch):
+    given = {}
+    #the four stages after ingest start together, and each one waits until all four are running
+    together = threading.Barrier(4, timeout=10)
+
+    def pooled(name):
+        def run(*values, workers):
+            given[name] = workers
+            if name != "report":
+                together.wait()
+            return name
+        return run
+
+    stages = {"ingest": {"run": lambda: "ingest"}}
+    for name in ["partials", "sketches", "runtimes"]:
+        stages[name] = {"after": ["ingest"], "workers": True, "run": pooled(name)}
+    stages["timeline"] = {"after": ["ingest"], "run": lambda: together.wait()}
+    stages["report"] = {"deps": ["partials", "sketches", "runtimes"], "workers": True, "run": pooled("report")}
+    monkeypatch.setattr(pipeline, "stages", lambda: stages)
+
+    assert pipeline.run(workers=8) == []
+    #8 processes split between the three stages that use them, not 8 each. The stage that runs on its own gets all of them
+    assert given == {"partials": 3, "sketches": 3, "runtimes": 2, "report": 8}
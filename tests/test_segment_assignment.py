@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
+import pytest
+
+import cache_utils
+import segment_assignment
+
+@pytest.fixture(autouse=True)
+def in_tmp(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+def segments(*xs):
+    return gpd.GeoDataFrame(geometry=[shapely.LineString([(x, 0), (x + 100, 0)]) for x in xs], crs="EPSG:26910")
+
+def pings():
+    return pd.DataFrame({"Time": [1, 2, 3], "Trip ID": [7, 7, 7], "x": [-123.4, -123.4, -123.4], "y": [48.4, 48.4, 48.4],
+                         "utm_x": [10.0, 150.0, 5000.0], "utm_y": [0.0, 5.0, 0.0], "service_date": [20240119] * 3})
+
+def assignment_folders():
+    return sorted(os.listdir(os.path.join(cache_utils.cache_folder, "segment_assignment")))
+
+def test_assigning_leaves_other_networks_to_the_main_process():
+    old, new = segments(0), segments(0, 120)
+    segment_assignment.assign_segments(pings(), old)
+    assigned = segment_assignment.assign_segments(pings(), new)
+    assert sorted(assigned.buffer_id) == [0, 1]
+
+    #workers don't prune: both networks are still there until prune_assignments runs
+    assert assignment_folders() == sorted([segment_assignment.network_key(old), segment_assignment.network_key(new)])
+    segment_assignment.prune_assignments(new)
+    assert assignment_folders() == [segment_assignment.network_key(new)]
+
+def test_prune_skips_entries_removed_by_another_process(monkeypatch):
+    folder = os.path.join(cache_utils.cache_folder, "segment_assignment")
+    os.makedirs(os.path.join(folder, "old", "20240119.parquet"))
+    os.makedirs(os.path.join(folder, "current"))
+
+    #another process gets to the old folder first
+    def removed_already(path):
+        raise FileNotFoundError(os.path.join(path, "20240119.parquet"))
+    monkeypatch.setattr(cache_utils.shutil, "rmtree", removed_already)
+
+    cache_utils.prune_cache("segment_assignment", "current")
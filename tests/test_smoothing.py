@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from smoothing import rolling_percentile, lowess
+
+#shorter than, equal to and longer than the window
+@pytest.mark.parametrize("length", [1, 5, 10, 37])
+@pytest.mark.parametrize("q", [10, 50, 90])
+def test_rolling_percentile_matches_pandas_rolling_apply(length, q):
+    values = np.random.default_rng(length).normal(20, 5, length)
+    expected = pd.Series(values).rolling(10, min_periods=1, center=True).apply(lambda window: np.percentile(window, q), raw=True)
+
+    np.testing.assert_allclose(rolling_percentile(values, q, window=10), expected.to_numpy(), rtol=1e-12)
+
+def test_rolling_percentile_of_nothing():
+    assert len(rolling_percentile([], 50)) == 0
+
+#a day of runtimes by departure time, like the runtime by time plots
+def runtimes(count):
+    rng = np.random.default_rng(count)
+    x = np.sort(rng.uniform(5 * 3600, 25 * 3600, count))
+    y = 1800 + 600 * np.sin(x / 86400 * 4 * np.pi) + rng.normal(0, 120, count)
+    return x, y
+
+def test_lowess_without_delta_is_the_exact_statsmodels_fit():
+    sm = pytest.importorskip("statsmodels.api")
+    x, y = runtimes(300)
+
+    np.testing.assert_array_equal(lowess(y, x, delta_fraction=0), sm.nonparametric.lowess(y, x, frac=.3))
+
+#The default delta interpolates between local fits. On this data it's a few seconds off the exact fit; 1% of the runtime range is the bound
+@pytest.mark.parametrize("count", [200, 2000])
+def test_lowess_default_delta_stays_close_to_the_exact_fit(count):
+    sm = pytest.importorskip("statsmodels.api")
+    x, y = runtimes(count)
+
+    fitted = lowess(y, x)
+    exact = sm.nonparametric.lowess(y, x, frac=.3)
+    np.testing.assert_array_equal(fitted[:, 0], exact[:, 0])
+    assert np.abs(fitted[:, 1] - exact[:, 1]).max() < 0.01 * np.ptp(y)
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import analysis
+import pipeline
+import speed_cube
+
+@pytest.fixture(autouse=True)
+def in_tmp(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+#segment partials merged by weekday and hour, as speed_partials.merge_partials returns them
+def merged(speed):
+    return pd.DataFrame({"buffer_id": [1, 2], "weekday": [0, 3], "hour": [8, 17], "speed_sum": [2 * speed, 30.0],
+                         "speed_sq_sum": [2 * speed * speed, 900.0], "count": [2, 1]})
+
+def cube(speed):
+    return speed_cube.cube_from_partials(merged(speed))
+
+def test_each_window_gets_its_own_file():
+    speed_cube.save_speed_cube(cube(10.0), 20240901, None)
+    assert speed_cube.load_speed_cube(20240901, None).equals(cube(10.0))
+    #any other window misses instead of reading the wrong cube
+    with pytest.raises(FileNotFoundError):
+        speed_cube.load_speed_cube(20240801, None)
+    with pytest.raises(FileNotFoundError):
+        speed_cube.load_speed_cube(20240901, 20240930)
+
+    #only the latest window is kept
+    speed_cube.save_speed_cube(cube(20.0), np.int64(20240801), 20240831)
+    assert speed_cube.load_speed_cube(20240801, 20240831).equals(cube(20.0))
+    with pytest.raises(FileNotFoundError):
+        speed_cube.load_speed_cube(20240901, None)
+
+def test_an_ad_hoc_cube_is_not_loaded_by_the_aggregates_stage(monkeypatch):
+    monkeypatch.setattr(analysis.timeline_store, "recent_start_date", lambda file_limit: 20240901)
+    monkeypatch.setattr(analysis.speed_partials, "merge_partials",
+                        lambda level, start_date, end_date, by: merged(10.0 if end_date is None else 99.0))
+    stage = pipeline.stages()["aggregates"]
+
+    stage["run"](None, 3)
+    assert stage["load"](3).equals(cube(10.0))
+
+    #a notebook looking at another window afterwards. The stage's output is gone, so the stage reruns instead of loading this one
+    analysis.segment_speed_cube(start_date="2024-08-01", end_date="2024-08-31", update=False)
+    assert not all(map(os.path.exists, stage["outputs"]))
+    with pytest.raises(FileNotFoundError):
+        stage["load"](3)
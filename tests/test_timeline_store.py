@@ -0,0 +1,39 @@
+import os
+
+import pandas as pd
+import pytest
+
+import timeline_store
+
+@pytest.fixture(autouse=True)
+def in_tmp(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(timeline_store.csv_folder)
+
+#pings on the local (Pacific) service dates given, one per date
+def write_csv(filename, dates, speed, mtime):
+    times = [int(pd.Timestamp(date + " 12:00", tz="America/Los_Angeles").timestamp()) for date in dates]
+    path = os.path.join(timeline_store.csv_folder, filename)
+    pd.DataFrame({"Time": times, "Route": "4", "Header": 1, "Trip ID": 7, "Speed": speed,
+                  "x": -123.36, "y": 48.43, "Occupancy Status": 0}).to_csv(path, index=False)
+    os.utime(path, (mtime, mtime))
+
+def test_csv_rewritten_under_the_same_name_is_converted_again(capsys):
+    filename = "2024-09-01_to_2024-09-03-timeline.csv"
+    write_csv(filename, ["2024-09-01", "2024-09-02", "2024-09-03"], 20.0, 1_700_000_000)
+    timeline_store.convert_csv_to_parquet()
+
+    #unchanged: nothing to do
+    capsys.readouterr()
+    timeline_store.convert_csv_to_parquet()
+    assert "Converting" not in capsys.readouterr().out
+
+    #rewritten in place (like fix()), now without 2024-09-03
+    write_csv(filename, ["2024-09-01", "2024-09-02"], 30.0, 1_700_000_100)
+    manifest = timeline_store.convert_csv_to_parquet()
+
+    pings = timeline_store.read_source(filename[:-len(".csv")])
+    assert sorted(pings.service_date) == [20240901, 20240902]
+    assert list(pings.Speed) == [30.0, 30.0]
+    assert manifest[filename]["end"] == 20240902
+    assert manifest[filename]["mtime"] == 1_700_000_100
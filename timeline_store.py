@@ -0,0 +1,218 @@
+import os
+import glob
+import json
+import functools
+import operator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import shapely
+from pyproj import Transformer
+
+#Raw weekly timeline files exported from MongoDB
+csv_folder = "historical speed data/data"
+#Columnar copy of the same pings, partitioned by service date (service_date=YYYYMMDD/). Local hour and weekday are stored alongside
+store_folder = "historical speed data/parquet"
+#Records which csv files have been converted and which service dates they cover. The leading underscore keeps pyarrow from treating it as data
+manifest_path = store_folder + "/_manifest.json"
+
+#Bumped when write_partitions starts storing something new. Files converted under an older version are converted again
+schema_version = 3
+
+#lon/lat to NAD83 UTM 10N, done once at ingest and stored as utm_x/utm_y so loading never has to reproject
+to_utm = Transformer.from_crs("EPSG:4326", "EPSG:26910", always_xy=True)
+
+timeline_dtypes = {"Time": np.int64, "Route": str, "Header": np.int64, "Trip ID": np.int64, "Speed": np.float64, "x": np.float64, "y": np.float64, "Occupancy Status": np.int64}
+
+#Opt-in compact in-memory schema. Occupancy Status isn't used by any analysis, so it isn't read at all.
+#Time fits unsigned 32-bit seconds until 2106, speeds don't need more than float32, and float32 coordinates are within about a metre.
+#Route and Header repeat constantly, so they're categorical
+compact_columns = ["Time", "Route", "Header", "Trip ID", "Speed", "x", "y", "utm_x", "utm_y", "service_date", "hour", "weekday"]
+compact_types = {"Time": pa.uint32(), "Trip ID": pa.uint32(), "Speed": pa.float32(), "x": pa.float32(), "y": pa.float32(), "utm_x": pa.float32(), "utm_y": pa.float32()}
+compact_categories = ["Route", "Header"]
+
+partitioning = ds.partitioning(pa.schema([("service_date", pa.int32())]), flavor="hive")
+
+#Turn a date-like value (string, date, Timestamp) into the YYYYMMDD integer used as the partition key
+def date_key(date):
+    date = pd.Timestamp(date)
+    return date.year * 10000 + date.month * 100 + date.day
+
+#UTC offset (seconds) of every epoch timestamp in Pacific time. Offsets are looked up from a table of whole UTC hours
+#covering the data (DST changes happen on the hour), so only that small table goes through tz_convert
+def local_offsets(time):
+    time = np.asarray(time, dtype=np.int64)
+    if len(time) == 0:
+        return time
+    hours = np.arange(time.min() // 3600 * 3600, time.max() + 3600, 3600)
+    local_hours = pd.DatetimeIndex(pd.to_datetime(hours, unit='s', utc=True)).tz_convert('America/Los_Angeles').tz_localize(None)
+    offsets = local_hours.asi8 // 10**9 - hours
+
+    return offsets[np.searchsorted(hours, time, side='right') - 1]
+
+#Local (Pacific) service date (YYYYMMDD), hour (0-23) and weekday (Monday = 0) of each epoch timestamp
+def local_time_keys(time):
+    local = np.asarray(time, dtype=np.int64) + local_offsets(time)
+    days = local // 86400
+
+    #turn day numbers into YYYYMMDD through the handful of distinct days
+    unique_days, inverse = np.unique(days, return_inverse=True)
+    dates = pd.DatetimeIndex(unique_days.astype('datetime64[D]'))
+    service_date = (dates.year * 10000 + dates.month * 100 + dates.day).to_numpy().astype(np.int32)[inverse]
+
+    hour = (local % 86400 // 3600).astype(np.int8)
+    #1970-01-01 was a Thursday
+    weekday = ((days + 3) % 7).astype(np.int8)
+
+    return service_date, hour, weekday
+
+#Local (Pacific) calendar date of each epoch timestamp, as a YYYYMMDD integer
+def service_date_key(time):
+    return local_time_keys(time)[0]
+
+#Add service_date, hour and weekday to a timeline that was read without them
+def add_local_time_keys(timeline):
+    if 'Time' not in timeline.columns or all(column in timeline.columns for column in ["service_date", "hour", "weekday"]):
+        return timeline
+    timeline['service_date'], timeline['hour'], timeline['weekday'] = local_time_keys(timeline['Time'])
+    return timeline
+
+def read_manifest():
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def write_manifest(manifest):
+    os.makedirs(store_folder, exist_ok=True)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+#Store files written from one source (csv) file, across all of its service date partitions
+def source_files(source_name):
+    return sorted(glob.glob(os.path.join(store_folder, "service_date=*", glob.escape(source_name) + "-*.parquet")))
+
+#Write a frame of pings into the store. Files are named after source_name, and whatever an earlier conversion of the same
+#source wrote is removed first, so a rewritten csv replaces its old pings even on dates it no longer covers
+def write_partitions(df, source_name):
+    for path in source_files(source_name):
+        os.remove(path)
+
+    df = df.copy()
+    df['Route'] = df['Route'].astype(str)
+    df['utm_x'], df['utm_y'] = to_utm.transform(df['x'].to_numpy(), df['y'].to_numpy())
+    df['service_date'], df['hour'], df['weekday'] = local_time_keys(df['Time'])
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    ds.write_dataset(table, store_folder, format="parquet", partitioning=partitioning,
+                     basename_template=source_name + "-{i}.parquet", existing_data_behavior="overwrite_or_ignore")
+
+    return {"start": int(df['service_date'].min()), "end": int(df['service_date'].max()), "rows": len(df), "schema": schema_version}
+
+#Size and modification time of a csv, as recorded in its manifest entry. Enough to notice a file rewritten under the same name
+def csv_stamp(path):
+    return {"size": os.path.getsize(path), "mtime": os.path.getmtime(path)}
+
+#Convert any csv in historical speed data/data that isn't in the store yet, or has changed since it was converted.
+#Cheap to call when everything is already converted
+def convert_csv_to_parquet(overwrite = False):
+    manifest = read_manifest()
+
+    for filename in sorted(os.listdir(csv_folder)):
+        if not filename.endswith(".csv"):
+            continue
+        stamp = csv_stamp(csv_folder + "/" + filename)
+        entry = manifest.get(filename, {})
+        if entry.get("schema", 1) >= schema_version and {key: entry.get(key) for key in stamp} == stamp and not overwrite:
+            continue
+
+        print("Converting " + filename)
+        df = pd.read_csv(csv_folder + "/" + filename, dtype=timeline_dtypes)
+        if df.empty:
+            continue
+
+        manifest[filename] = dict(write_partitions(df, filename[:-len(".csv")]), **stamp)
+        #save after every file so an interrupted conversion picks up where it left off
+        write_manifest(manifest)
+
+    return manifest
+
+#Earliest service date covered by the file_limit most recent source files. Keeps the old retrieve_timeline(file_limit) behaviour on top of the store
+def recent_start_date(file_limit = 1):
+    manifest = read_manifest()
+    files = pd.DataFrame({'filename': list(manifest.keys())})
+    if files.empty:
+        return None
+    files['start_date'] = files.filename.str.extract(r'(\d{4}-\d{2}-\d{2})')[0]
+    files = files.sort_values(by='start_date', ascending=False).head(file_limit)
+
+    return min(manifest[filename]['start'] for filename in files.filename)
+
+#Read pings from the store. Date range, routes and columns are pushed down to pyarrow, so only the matching partitions, row groups and columns are read
+#With compact=True, unused columns are skipped (unless columns is given) and the rest are narrowed to the compact schema before they reach pandas
+def read_timeline(start_date = None, end_date = None, routes = None, columns = None, compact = False):
+    dataset = ds.dataset(store_folder, format="parquet", partitioning=partitioning)
+
+    filters = []
+    if start_date is not None:
+        start_date = start_date if isinstance(start_date, (int, np.integer)) else date_key(start_date)
+        filters.append(ds.field("service_date") >= start_date)
+    if end_date is not None:
+        end_date = end_date if isinstance(end_date, (int, np.integer)) else date_key(end_date)
+        filters.append(ds.field("service_date") <= end_date)
+    if routes is not None:
+        filters.append(ds.field("Route").isin([str(route) for route in routes]))
+
+    expression = functools.reduce(operator.and_, filters) if filters else None
+
+    if compact and columns is None:
+        columns = compact_columns
+
+    table = dataset.to_table(columns=columns, filter=expression)
+    if compact:
+        table = compact_table(table)
+    return table.to_pandas()
+
+#Service dates (YYYYMMDD) that have a partition in the store, within an optional window
+def partition_dates(start_date = None, end_date = None):
+    if not os.path.exists(store_folder):
+        return []
+    dates = sorted(int(name[len("service_date="):]) for name in os.listdir(store_folder) if name.startswith("service_date="))
+    return [date for date in dates if (start_date is None or date >= start_date) and (end_date is None or date <= end_date)]
+
+#Pings that came from one source (csv) file, across all of its service date partitions
+def read_source(source_name, columns = None):
+    dataset = ds.dataset(source_files(source_name), format="parquet", partitioning=partitioning, partition_base_dir=store_folder)
+    return dataset.to_table(columns=columns).to_pandas()
+
+def compact_table(table):
+    for name in table.column_names:
+        if name in compact_types:
+            table = table.set_column(table.schema.get_field_index(name), name, pc.cast(table[name], compact_types[name]))
+        elif name in compact_categories:
+            table = table.set_column(table.schema.get_field_index(name), name, table[name].dictionary_encode())
+    return table
+
+#Deep memory use of a timeline in MB per million pings, for comparing schemas
+def memory_per_million_pings(timeline):
+    if len(timeline) == 0:
+        return 0.0
+    return timeline.memory_usage(deep=True).sum() / len(timeline) * 1e6 / 2**20
+
+#Projected (EPSG:26910) points for the selected pings (mask), built from the stored utm_x/utm_y. Lets a timeline stay geometry-free
+#until a spatial operation needs points, and then only for the pings it uses. Falls back to an existing geometry column
+def ping_points(timeline, mask = None):
+    if 'utm_x' in timeline.columns:
+        x = timeline['utm_x'].to_numpy()
+        y = timeline['utm_y'].to_numpy()
+        if mask is not None:
+            x = x[mask]
+            y = y[mask]
+        return shapely.points(x, y)
+
+    geometry = timeline.geometry.to_numpy()
+    return geometry if mask is None else geometry[mask]